@@ -0,0 +1,312 @@
+"""Per-band statistics of the challenge or SSL4EO-S12 v1.1 data, e.g. to regenerate the normalization constants.
+
+Example, computing the statistics of the challenge data with the S2 shift in 8 processes:
+
+    python band_statistics.py --data-dir /path/to/challenge_data --output moments.json --n-workers 8
+
+The resulting file can be passed as moments to E2SChallengeDataset and ShardDataset, or loaded with load_moments.
+"""
+import json
+import argparse
+import numpy as np
+from typing import List
+
+from process_pool import map_bounded, worker_state
+
+
+# Default histogram range per modality folder. Values outside of the range are counted in the first or last bin.
+VALUE_RANGES = {
+    's2l1c': (0.0, 20000.0), 's2l2a': (0.0, 20000.0), 's1': (-60.0, 20.0),
+    'S2L1C': (0.0, 20000.0), 'S2L2A': (0.0, 20000.0), 'S1GRD': (-60.0, 20.0),
+}
+
+
+class BandStatistics:
+
+    def __init__(self, n_bands: int, value_range: tuple, n_bins: int = 2000, n_seasons: int = None):
+        """Mergeable streaming accumulator of per-band count, mean, variance, minimum, maximum and histogram.
+
+        The moments are accumulated with Welford's algorithm, merged per batch of values (Chan et al.), in float64.
+        Non-finite values are ignored. Accumulators of disjoint parts of the data are combined with merge, giving the
+        same result as a single pass over all data, up to floating point rounding.
+
+        Parameters
+        ----------
+        n_bands : int
+            Number of bands.
+        value_range : tuple[float, float]
+            Lower and upper edge of the histogram. Values outside of the range are counted in the first or last bin.
+        n_bins : int
+            Number of equally wide histogram bins. Default is 2000.
+        n_seasons : int
+            Optional, number of seasons to accumulate separately. Default is None, where all seasons are accumulated together.
+        """
+        self.n_bands = n_bands
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+        self.n_bins = n_bins
+        self.n_seasons = n_seasons
+        shape = (n_seasons or 1, n_bands)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self._mean = np.zeros(shape, dtype=np.float64)
+        self._m2 = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.histogram = np.zeros(shape + (n_bins,), dtype=np.int64)
+
+    def update(self, values):
+        """Add values of shape [n_samples, n_seasons, n_bands, height, width] or [n_samples, n_bands, height, width].
+
+        With n_seasons set, the values must have a season dimension with n_seasons entries.
+        """
+        values = np.asarray(values)
+        if self.n_seasons is not None:
+            assert values.ndim == 5 and values.shape[1] == self.n_seasons, f"Values of shape [n_samples, {self.n_seasons}, n_bands, height, width] expected."
+        # One sample at a time, to bound the memory of the float64 copies
+        for sample in values:
+            if self.n_seasons is not None:
+                grouped = sample.reshape(self.n_seasons, self.n_bands, -1)
+            else:
+                grouped = np.moveaxis(sample, -3, 0).reshape(1, self.n_bands, -1)
+            self._update_grouped(grouped.astype(np.float64))
+
+    def _update_grouped(self, x):
+        """Add values of shape [n_groups, n_bands, n_values] in float64."""
+        finite = np.isfinite(x)
+        all_finite = finite.all()
+        if all_finite:
+            count = np.full(x.shape[:2], x.shape[-1], dtype=np.int64)
+            mean = x.mean(axis=-1)
+            m2 = np.square(x - mean[..., None]).sum(axis=-1)
+            self.min = np.minimum(self.min, x.min(axis=-1))
+            self.max = np.maximum(self.max, x.max(axis=-1))
+        else:
+            count = finite.sum(axis=-1)
+            x = np.where(finite, x, np.nan)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.where(count > 0, np.nansum(x, axis=-1) / count, 0.0)
+            m2 = np.nansum(np.square(x - mean[..., None]), axis=-1)
+            self.min = np.minimum(self.min, np.where(finite, x, np.inf).min(axis=-1))
+            self.max = np.maximum(self.max, np.where(finite, x, -np.inf).max(axis=-1))
+        self._merge_moments(count, mean, m2)
+
+        # Histogram of all groups and bands with a single bincount
+        low, high = self.value_range
+        bins = np.floor((x - low) * (self.n_bins / (high - low)))
+        np.clip(bins, 0, self.n_bins - 1, out=bins)
+        if not all_finite:
+            bins[~finite] = 0
+        offsets = np.arange(x.shape[0] * x.shape[1]).reshape(x.shape[:2] + (1,)) * self.n_bins
+        bins = bins.astype(np.int64) + offsets
+        if not all_finite:
+            bins = bins[finite]
+        self.histogram += np.bincount(bins.ravel(), minlength=self.histogram.size).reshape(self.histogram.shape)
+
+    def _merge_moments(self, count, mean, m2):
+        total = self.count + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self._mean
+            self._mean = np.where(total > 0, self._mean + delta * count / total, 0.0)
+            self._m2 = np.where(total > 0, self._m2 + m2 + np.square(delta) * self.count * count / total, 0.0)
+        self.count = total
+
+    def merge(self, other: 'BandStatistics'):
+        """Add the statistics accumulated by another BandStatistics with the same configuration."""
+        assert (other.n_bands, other.value_range, other.n_bins, other.n_seasons) == (self.n_bands, self.value_range, self.n_bins, self.n_seasons), \
+            "Only statistics with the same bands, histogram bins and seasons can be merged."
+        self._merge_moments(other.count, other._mean, other._m2)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.histogram += other.histogram
+        return self
+
+    @property
+    def mean(self):
+        """Mean per band, of shape [n_seasons, n_bands] if n_seasons is set, otherwise [n_bands]."""
+        return self._squeeze(self._mean)
+
+    @property
+    def std(self):
+        """Population standard deviation per band, as np.std."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._squeeze(np.sqrt(self._m2 / self.count))
+
+    def percentile(self, q: float):
+        """Approximate q-th percentile per band from the histogram, interpolated linearly within the bins."""
+        low, high = self.value_range
+        width = (high - low) / self.n_bins
+        cdf = np.cumsum(self.histogram, axis=-1)
+        target = q / 100 * self.count[..., None]
+        # First bin which reaches the target, and the fraction of it below the target
+        bin_ind = np.minimum((cdf < target).sum(axis=-1, keepdims=True), self.n_bins - 1)
+        below = np.take_along_axis(cdf, bin_ind, axis=-1) - np.take_along_axis(self.histogram, bin_ind, axis=-1)
+        in_bin = np.take_along_axis(self.histogram, bin_ind, axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.where(in_bin > 0, (target - below) / in_bin, 0.0)
+        values = low + (bin_ind + np.clip(fraction, 0, 1)) * width
+        # The histogram range does not bound the data
+        values = np.clip(values[..., 0], self.min, self.max)
+        return self._squeeze(values)
+
+    def _squeeze(self, values):
+        return values if self.n_seasons is not None else values[0]
+
+    def to_dict(self, percentiles: List[float] = (1, 99)):
+        """Statistics as json-serializable lists, nested as [season][band] if n_seasons is set."""
+        return {
+            'mean': self.mean.tolist(),
+            'std': self.std.tolist(),
+            'min': self._squeeze(self.min).tolist(),
+            'max': self._squeeze(self.max).tolist(),
+            'count': self._squeeze(self.count).tolist(),
+            'percentiles': {str(q): self.percentile(q).tolist() for q in percentiles},
+        }
+
+
+def _accumulate(indices):
+    """Accumulate the statistics of the samples at indices, per modality."""
+    dataset = worker_state['dataset']
+    stats = {}
+    for idx in indices:
+        data = dataset[idx]
+        if isinstance(data, dict) and 'data' in data:
+            data = data['data']
+        for modality, values in data.items():
+            values = values.numpy()
+            if modality not in stats:
+                stats[modality] = BandStatistics(values.shape[-3], worker_state['value_ranges'][modality], n_bins=worker_state['n_bins'],
+                                                 n_seasons=values.shape[1] if worker_state['per_season'] else None)
+            stats[modality].update(values)
+    return stats
+
+
+def compute_band_statistics(dataset,
+                            n_workers: int = 4,
+                            per_season: bool = False,
+                            n_bins: int = 2000,
+                            value_ranges: dict = None,
+                            chunk_size: int = 16,
+                            indices: List[int] = None,
+                            mp_context: str = None
+                           ):
+    """Per-band statistics of a dataset in a single streaming pass, in a pool of worker processes.
+
+    Each worker loads chunks of samples and accumulates their statistics in a BandStatistics per modality. The
+    accumulators of the chunks are merged as they complete, so the memory use does not depend on the dataset size.
+
+    Parameters
+    ----------
+    dataset : E2SChallengeDataset or SSL4EOS12Dataset
+        Dataset with concat=False, so that each sample is a dict of modalities. Use shift_s2_channels of E2SChallengeDataset
+        to compute the statistics with or without the S2 shift, and no transform or normalization for the normalization constants.
+    n_workers : int
+        Number of worker processes. Default is 4.
+    per_season : bool
+        Toggle separate statistics for each position in the season (time) dimension. Requires outputs with a time dimension,
+        i.e. single_timestamp=False for SSL4EOS12Dataset, and randomize_seasons=False for E2SChallengeDataset. Default is False.
+    n_bins : int
+        Number of histogram bins, used for the percentiles. Default is 2000.
+    value_ranges : dict
+        Histogram range per modality. Defaults to VALUE_RANGES.
+    chunk_size : int
+        Number of samples per task sent to a worker. Default is 16.
+    indices : list[int]
+        Optional, indices of the samples to include. Defaults to all samples.
+    mp_context : str
+        Multiprocessing start method, e.g. 'fork' or 'spawn'. Defaults to the platform default.
+
+    Returns
+    -------
+    dict[str, BandStatistics]
+        Statistics per modality.
+    """
+    assert not dataset.concat, "The dataset must output a dict of modalities, set concat=False."
+    if indices is None:
+        indices = list(range(len(dataset)))
+    value_ranges = {**VALUE_RANGES, **(value_ranges or {})}
+
+    stats = {}
+    chunks = ((indices[i:i + chunk_size],) for i in range(0, len(indices), chunk_size))
+    state = {'dataset': dataset, 'n_bins': n_bins, 'value_ranges': value_ranges, 'per_season': per_season}
+    for chunk_stats in map_bounded(_accumulate, chunks, state, n_workers=n_workers, mp_context=mp_context):
+        for modality, modality_stats in chunk_stats.items():
+            if modality in stats:
+                stats[modality].merge(modality_stats)
+            else:
+                stats[modality] = modality_stats
+    return stats
+
+
+def save_statistics(stats: dict, path: str, percentiles: List[float] = (1, 99), **metadata):
+    """Save the statistics per modality to a json file, with additional metadata, e.g. shift_s2_channels."""
+    per_season = any(s.n_seasons is not None for s in stats.values())
+    content = {**metadata, 'per_season': per_season, 'modalities': {m: s.to_dict(percentiles) for m, s in stats.items()}}
+    with open(path, 'w') as f:
+        json.dump(content, f, indent=2)
+
+
+def load_moments(path: str, season: int = None, shift_s2_channels: bool = None):
+    """Load the mean and standard deviation per modality from a file written by save_statistics.
+
+    Parameters
+    ----------
+    path : str, path-like
+        Path to the statistics file.
+    season : int
+        Season to load from statistics computed with per_season=True. Must be None otherwise.
+    shift_s2_channels : bool
+        Optional, S2 shift of the data which is normalized with the moments. A ValueError is raised if it differs from the
+        shift_s2_channels recorded by save_statistics. Default is None, where the recorded shift is not checked.
+
+    Returns
+    -------
+    dict
+        (mean, std) lists per modality, in the format of challenge_dataset.MODALITY_MOMENTS.
+    """
+    with open(path, 'r') as f:
+        content = json.load(f)
+    if content['per_season'] != (season is not None):
+        raise ValueError(f"""Statistics in {path} were computed {'per season, select a season' if content['per_season'] else 'over all seasons, season must be None'}.""")
+    recorded_shift = content.get('shift_s2_channels')
+    if shift_s2_channels is not None and recorded_shift is not None and recorded_shift != shift_s2_channels:
+        raise ValueError(f"""Statistics in {path} were computed with shift_s2_channels={recorded_shift}, but shift_s2_channels={shift_s2_channels} was requested.""")
+    moments = {}
+    for modality, s in content['modalities'].items():
+        mean, std = (s['mean'], s['std']) if season is None else (s['mean'][season], s['std'][season])
+        moments[modality] = (mean, std)
+    return moments
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Compute per-band statistics of the challenge or SSL4EO-S12 v1.1 data.')
+    parser.add_argument('--dataset', choices=['challenge', 'ssl4eo'], default='challenge')
+    parser.add_argument('--data-dir', required=True)
+    parser.add_argument('--output', required=True, help='Output json file.')
+    parser.add_argument('--modalities', nargs='+', default=None)
+    parser.add_argument('--no-shift', action='store_true', help='Do not shift the S2 channels of the challenge data by 1000.')
+    parser.add_argument('--per-season', action='store_true')
+    parser.add_argument('--n-workers', type=int, default=4)
+    parser.add_argument('--n-bins', type=int, default=2000)
+    parser.add_argument('--percentiles', type=float, nargs='+', default=[1, 99])
+    parser.add_argument('--index-file', default=None, help='Optional sample index, see sample_index.py.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    if args.dataset == 'challenge':
+        from challenge_dataset import E2SChallengeDataset
+        dataset = E2SChallengeDataset(args.data_dir, modalities=args.modalities or ['s2l1c', 's2l2a', 's1'], concat=False,
+                                      shift_s2_channels=not args.no_shift, index_file=args.index_file)
+        shift_s2_channels = not args.no_shift
+    else:
+        from ssl4eos12_dataset import SSL4EOS12Dataset
+        dataset = SSL4EOS12Dataset(args.data_dir, modalities=args.modalities, concat=False, index_file=args.index_file)
+        # SSL4EO-S12 v1.1 includes the shift
+        shift_s2_channels = True
+
+    stats = compute_band_statistics(dataset, n_workers=args.n_workers, per_season=args.per_season, n_bins=args.n_bins)
+    save_statistics(stats, args.output, percentiles=args.percentiles, dataset=args.dataset, shift_s2_channels=shift_s2_channels,
+                    n_files=len(dataset))
+    for modality, s in stats.items():
+        print(f'{modality} mean: {np.round(s.mean, 3).tolist()}')
+        print(f'{modality} std: {np.round(s.std, 3).tolist()}')
@@ -0,0 +1,257 @@
+"""Throughput benchmark of E2SChallengeDataset and SSL4EOS12Dataset on synthetic data.
+
+Example, creating 64 synthetic challenge samples and benchmarking a matrix of settings:
+
+    python benchmark.py --data-dir /tmp/e2s_bench --create-data 64 --num-workers 0 2 --batch-size 1 8 --concat 0 1
+
+For SSL4EO-S12 v1.1, use --dataset ssl4eo, which creates files with 64 samples each and the SSL4EO-S12 folder names.
+"""
+import os
+import json
+import time
+import resource
+import argparse
+import itertools
+import numpy as np
+import zarr
+import torch
+import multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from loader_stats import STAGES, LoaderStats
+
+
+# Channels and dtype per modality folder
+CHALLENGE_MODALITIES = {'s2l1c': (13, np.uint16), 's2l2a': (12, np.uint16), 's1': (2, np.float32)}
+SSL4EO_MODALITIES = {'S2L1C': (13, np.uint16), 'S2L2A': (12, np.uint16), 'S1GRD': (2, np.float32)}
+
+
+def make_synthetic_data(data_dir: str,
+                        n_files: int = 64,
+                        modalities: dict = None,
+                        samples_per_file: int = 1,
+                        num_timestamps: int = 4,
+                        size: int = 264,
+                        seed: int = 0
+                       ):
+    """Write random zarr.zip files with the layout of the challenge or SSL4EO-S12 v1.1 data.
+
+    Each modality folder gets n_files files with the same names, holding a 'bands' array with dimensions
+    (sample, time, band, y, x), chunked per sample and timestamp, and consolidated metadata.
+
+    Parameters
+    ----------
+    data_dir : str, path-like
+        Output folder.
+    n_files : int
+        Number of files per modality. Default is 64.
+    modalities : dict
+        Number of channels and dtype per modality folder. Defaults to CHALLENGE_MODALITIES.
+    samples_per_file : int
+        Number of samples per file. 1 for the challenge data, 64 for SSL4EO-S12 v1.1. Default is 1.
+    num_timestamps : int
+        Number of timestamps. Default is 4.
+    size : int
+        Height and width. Default is 264.
+    seed : int
+        Seed of the random data. Default is 0.
+    """
+    import xarray as xr
+    modalities = modalities or CHALLENGE_MODALITIES
+    rng = np.random.default_rng(seed)
+    for modality, (n_channels, dtype) in modalities.items():
+        os.makedirs(os.path.join(data_dir, modality), exist_ok=True)
+        for i in range(n_files):
+            shape = (samples_per_file, num_timestamps, n_channels, size, size)
+            if np.issubdtype(dtype, np.integer):
+                values = rng.integers(0, 10000, size=shape, dtype=dtype)
+            else:
+                values = rng.normal(-15, 5, size=shape).astype(dtype)
+            ds = xr.Dataset({'bands': (('sample', 'time', 'band', 'y', 'x'), values)},
+                            coords={'time': np.arange(num_timestamps), 'band': [f'B{b}' for b in range(n_channels)]})
+            store = zarr.storage.ZipStore(os.path.join(data_dir, modality, f'sample_{i:06d}.zarr.zip'), mode='w')
+            ds.to_zarr(store, mode='w', consolidated=True,
+                       encoding={'bands': {'chunks': (1, 1, n_channels, size, size)}})
+            store.close()
+
+
+def _create_dataset(kind, data_dir, modalities, transform, settings, stats=None):
+    if kind == 'challenge':
+        from challenge_dataset import E2SChallengeDataset, collate_fn
+        dataset = E2SChallengeDataset(data_dir, modalities=modalities, transform=transform, seasons=settings['seasons'],
+                                      concat=settings['concat'], shift_s2_channels=True, backend=settings['backend'],
+                                      stats=stats, batch_loading=settings['batch_loading'])
+    else:
+        from ssl4eos12_dataset import SSL4EOS12Dataset, collate_fn
+        dataset = SSL4EOS12Dataset(data_dir, modalities=modalities, transform=transform, concat=settings['concat'],
+                                   single_timestamp=settings['single_timestamp'], num_batch_samples=settings['num_batch_samples'], backend=settings['backend'],
+                                   stats=stats, batch_loading=settings['batch_loading'])
+    return dataset, collate_fn
+
+
+def _normalize_transform(n_channels):
+    from torchvision import transforms
+    return transforms.Compose([transforms.Normalize(mean=[1000.0] * n_channels, std=[500.0] * n_channels)])
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MB. ru_maxrss is kept across exec, so it would include the parent of a spawned process."""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_config(kind, data_dir, modalities, settings, max_batches, queue):
+    """Measure one configuration, in a separate process so that the peak RSS is not shared with other configurations."""
+    n_channels = sum((CHALLENGE_MODALITIES if kind == 'challenge' else SSL4EO_MODALITIES)[m][0] for m in modalities)
+    # Built before timing, so that the stages do not include importing torchvision
+    transform = _normalize_transform(n_channels) if settings['transform'] else None
+    stats = LoaderStats()
+    dataset, collate_fn = _create_dataset(kind, data_dir, modalities, transform, settings, stats=stats)
+    loader = DataLoader(dataset, batch_size=settings['batch_size'], num_workers=settings['num_workers'],
+                        collate_fn=stats.timed(collate_fn), shuffle=False)
+    # With single_timestamp, each file is one item per timestamp
+    items_per_file = dataset.num_timestamps if getattr(dataset, 'single_timestamp', False) else 1
+
+    n_items, n_samples, n_batches = 0, 0, 0
+    stats.reset()
+    t_start = time.perf_counter()
+    t_first = None
+    for batch in stats.iterate(loader):
+        if t_first is None:
+            t_first = time.perf_counter() - t_start
+        tensor = batch if isinstance(batch, torch.Tensor) else next(iter(batch.values()))
+        n_samples += tensor.shape[0]
+        n_items += min(settings['batch_size'], len(dataset) - n_items)
+        n_batches += 1
+        if max_batches is not None and n_batches >= max_batches:
+            break
+    elapsed = time.perf_counter() - t_start
+
+    del loader
+    summary = stats.summary()
+    queue.put({
+        **settings,
+        'files_per_s': n_items / items_per_file / elapsed,
+        'items_per_s': n_items / elapsed,
+        'samples_per_s': n_samples / elapsed,
+        'first_batch_s': t_first,
+        'elapsed_s': elapsed,
+        'peak_rss_mb': _peak_rss_mb(),
+        'worker_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 if settings['num_workers'] > 0 else 0.0,
+        # Time per dataset item of each stage, summed over the DataLoader workers, including items they loaded ahead
+        'stages': {stage: 1000 * summary['stages'][stage]['seconds'] / max(summary['items'], 1) for stage in STAGES},
+    })
+
+
+def run_benchmark(kind: str,
+                  data_dir: str,
+                  modalities: list = None,
+                  num_workers: list = (0,),
+                  batch_size: list = (1,),
+                  seasons: list = (4,),
+                  concat: list = (True,),
+                  single_timestamp: list = (False,),
+                  num_batch_samples: list = (None,),
+                  transform: list = (False,),
+                  backend: list = ('zarr',),
+                  batch_loading: list = (False,),
+                  max_batches: int = None
+                 ):
+    """Measure the loading throughput for every combination of the given settings.
+
+    Each configuration runs in a fresh process and reports the files, dataset items and samples per second, the time to
+    the first batch and the peak resident memory of the main process and, separately, of its DataLoader workers. The
+    DataLoader workers are spawned as well, so the time to the first batch includes their startup. The time per item of
+    each loading stage is measured through the dataset with a LoaderStats, see loader_stats.STAGES. Settings which
+    do not apply to a dataset class (seasons for SSL4EO-S12, single_timestamp and num_batch_samples for the challenge
+    data) are ignored.
+
+    Parameters
+    ----------
+    kind : str
+        'challenge' for E2SChallengeDataset or 'ssl4eo' for SSL4EOS12Dataset.
+    data_dir : str, path-like
+        Path to the data, e.g. created with make_synthetic_data.
+    modalities : list[str]
+        Modalities to load. Defaults to all modalities of the dataset class.
+    num_workers, batch_size, seasons, concat, single_timestamp, num_batch_samples, transform, backend, batch_loading : list
+        Values of each setting. transform toggles a Normalize transform.
+    max_batches : int
+        Optional, number of batches to load per configuration. Defaults to the whole dataset.
+
+    Returns
+    -------
+    list[dict]
+        One result per configuration.
+    """
+    modalities = modalities or list((CHALLENGE_MODALITIES if kind == 'challenge' else SSL4EO_MODALITIES).keys())
+    if kind == 'challenge':
+        single_timestamp, num_batch_samples = (False,), (None,)
+    else:
+        seasons = (4,)
+
+    names = ['num_workers', 'batch_size', 'seasons', 'concat', 'single_timestamp', 'num_batch_samples', 'transform', 'backend', 'batch_loading']
+    results = []
+    ctx = mp.get_context('spawn')
+    for values in itertools.product(num_workers, batch_size, seasons, concat, single_timestamp, num_batch_samples, transform, backend, batch_loading):
+        settings = dict(zip(names, values))
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_config, args=(kind, data_dir, modalities, settings, max_batches, queue))
+        process.start()
+        results.append(queue.get())
+        process.join()
+    return results
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the loading throughput of the dataset classes on synthetic data.')
+    parser.add_argument('--dataset', choices=['challenge', 'ssl4eo'], default='challenge')
+    parser.add_argument('--data-dir', required=True, help='Folder of the data. Synthetic data is created here with --create-data.')
+    parser.add_argument('--create-data', type=int, default=0, metavar='N_FILES', help='Create N_FILES synthetic files per modality first.')
+    parser.add_argument('--size', type=int, default=264, help='Height and width of the synthetic data.')
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[0])
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[1])
+    parser.add_argument('--seasons', type=int, nargs='+', default=[4])
+    parser.add_argument('--concat', type=int, nargs='+', default=[1])
+    parser.add_argument('--single-timestamp', type=int, nargs='+', default=[0])
+    parser.add_argument('--num-batch-samples', type=int, nargs='+', default=[0], help='0 loads all samples of a file.')
+    parser.add_argument('--transform', type=int, nargs='+', default=[0])
+    parser.add_argument('--backend', nargs='+', default=['zarr'], choices=['zarr', 'xarray'])
+    parser.add_argument('--batch-loading', type=int, nargs='+', default=[0])
+    parser.add_argument('--max-batches', type=int, default=None)
+    parser.add_argument('--output', default=None, help='Optional json lines file to append the results to.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    modalities = CHALLENGE_MODALITIES if args.dataset == 'challenge' else SSL4EO_MODALITIES
+    if args.create_data > 0:
+        make_synthetic_data(args.data_dir, args.create_data, modalities=modalities, size=args.size,
+                            samples_per_file=1 if args.dataset == 'challenge' else 64)
+
+    results = run_benchmark(
+        args.dataset, args.data_dir,
+        num_workers=args.num_workers, batch_size=args.batch_size, seasons=args.seasons,
+        concat=[bool(c) for c in args.concat], single_timestamp=[bool(s) for s in args.single_timestamp],
+        num_batch_samples=[n or None for n in args.num_batch_samples], transform=[bool(t) for t in args.transform],
+        backend=args.backend, batch_loading=[bool(b) for b in args.batch_loading], max_batches=args.max_batches,
+    )
+    columns = ['num_workers', 'batch_size', 'seasons', 'concat', 'single_timestamp', 'num_batch_samples', 'transform', 'backend',
+               'batch_loading', 'files_per_s', 'items_per_s', 'samples_per_s', 'first_batch_s', 'peak_rss_mb', 'worker_peak_rss_mb']
+    print(' '.join(f'{c:>17}' for c in columns))
+    for result in results:
+        print(' '.join(f'{result[c]:>17.2f}' if isinstance(result[c], float) else f'{str(result[c]):>17}' for c in columns))
+        print('    Stage latency per item [ms]: ' + ', '.join(f'{k} {v:.1f}' for k, v in result['stages'].items()))
+
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            for result in results:
+                f.write(json.dumps({'dataset': args.dataset, **result}) + '\n')
@@ -2,10 +2,18 @@ import torch
 from torch.utils.data import Dataset
 import os
 import glob
-import xarray as xr
 import numpy as np
 from typing import List, Dict
 
+from band_statistics import load_moments
+from batching import empty_batch
+from loader_stats import LoaderStats, timed
+from read_ahead import ReadAhead, open_group
+from sample_cache import DecodedArray, SharedSampleCache, read_decoded
+from sample_index import SampleIndex
+from spatial_window import SpatialWindow, window_slices
+from store_cache import ZarrStoreCache, dim_axis, is_stored_as_decoded, read_orthogonal_selection
+
 
 # Mean and standard devation for the challenge data.
 # Note that these are different from the SSL4EO-S12 v1.1 moments.
@@ -30,6 +38,18 @@ S1GRD_MEAN_SSL4EO = [-12.577, -20.265]
 S1GRD_STD_SSL4EO = [5.179, 5.872]
 
 
+# Mean and standard deviation per modality folder, used by the built-in normalization of E2SChallengeDataset.
+MODALITY_MOMENTS = {
+    's1': (S1GRD_MEAN, S1GRD_STD),
+    's2l1c': (S2L1C_MEAN, S2L1C_STD),
+    's2l2a': (S2L2A_MEAN, S2L2A_STD),
+}
+MODALITY_MOMENTS_SSL4EO = {
+    's1': (S1GRD_MEAN_SSL4EO, S1GRD_STD_SSL4EO),
+    's2l1c': (S2L1C_MEAN_SSL4EO, S2L1C_STD_SSL4EO),
+    's2l2a': (S2L2A_MEAN_SSL4EO, S2L2A_STD_SSL4EO),
+}
+
 class E2SChallengeDataset(Dataset):
 
     def __init__(self, 
@@ -41,7 +61,19 @@ class E2SChallengeDataset(Dataset):
                  randomize_seasons: bool = False,
                  concat: bool = True,
                  output_file_name: bool = False,
-                 shift_s2_channels: bool = True
+                 shift_s2_channels: bool = True,
+                 normalize: bool = False,
+                 max_open_files: int = None,
+                 index_file: str = None,
+                 pin_memory: bool = False,
+                 backend: str = 'zarr',
+                 moments = None,
+                 seed: int = None,
+                 cache: SharedSampleCache = None,
+                 read_ahead: ReadAhead = None,
+                 stats: LoaderStats = None,
+                 window: SpatialWindow = None,
+                 batch_loading: bool = False
                 ):
         """Dataset class for the embed2scale challenge data
 
@@ -68,12 +100,59 @@ class E2SChallengeDataset(Dataset):
             shifted upward 1000 to have the range as SSL4EO-S12 v1.1. The background is that ESA decided 
             from 2022-01-25 to shift the DN values of S2 by 1000 upward. SSL4EO-S12 v1.1 includes this shift, 
             while the challenge data does not.
+        normalize : bool
+            Toggle per-band normalization with the mean and standard deviation of each modality, applied in place to the float32
+            output after reading, per sample or once per batch with load_batch, and before the transform. Uses the SSL4EO-S12 v1.1
+            moments if shift_s2_channels=True and the challenge data moments otherwise. The result is identical to a torchvision
+            Normalize transform with the same moments, but avoids the intermediate copies. Default is False.
+        max_open_files : int
+            Toggle caching of opened zarr.zip files. If given, up to max_open_files files are kept open in each worker process and 
+            reused for repeated access, closing the least recently used file when exceeded. Must be at least the number of modalities. 
+            The cached files are opened from disk, so read_ahead then only warms the operating system's file cache, see ReadAhead. 
+            Default is None, where the files are opened for every sample.
+        index_file : str, path-like
+            Optional, path to a sample index (.npy) created with sample_index.build_sample_index. The index is memory-mapped 
+            instead of listing data_path, and only samples with files for all modalities are included. If the file does not 
+            exist, or was built from another data_path or before files were added or removed, the index is built and saved to 
+            index_file, see SampleIndex.load_or_build. Default is None, where the files under data_path are listed.
+        pin_memory : bool
+            Toggle allocating batches in pinned memory when loading batches in the main process (DataLoader with num_workers=0). 
+            In DataLoader workers, batches are allocated in shared memory instead, use pin_memory in the DataLoader there. Default is False.
+        backend : str
+            Library used to read the zarr arrays, 'zarr' or 'xarray'. Default is 'zarr', which reads the selected seasons with zarr directly, 
+            without building dask task graphs, and only imports xarray for arrays which xarray would decode (masking or scaling). 
+            'xarray' reads every sample through xr.open_zarr. Both give identical outputs.
+        moments : dict or str, path-like
+            Optional, (mean, std) per modality used with normalize=True instead of the built-in moments, in the format of MODALITY_MOMENTS, 
+            or the path to a statistics file written by band_statistics.py. Must match shift_s2_channels, a ValueError is raised if the
+            statistics file records another shift_s2_channels. Default is None.
+        seed : int
+            Optional, seed of the randomized seasons. The seasons of a sample then only depend on the seed, the epoch set with set_epoch 
+            and the index, independent of the DataLoader worker or rank which loads it. Default is None, where the seasons are drawn 
+            with the global torch random number generator, which the DataLoader seeds per worker.
+        cache : sample_cache.SharedSampleCache
+            Optional, cache of the decoded files shared by all DataLoader workers and kept across epochs. The seasons are selected, 
+            and the shift, normalization and transform applied, after the lookup, so the outputs are unchanged. Default is None.
+        read_ahead : read_ahead.ReadAhead
+            Optional, reads the files of the current batch and of the next samples of the sampler order in background threads, for 
+            storage with a high latency. The order is set by LocalityAwareSampler.set_epoch, see set_sample_order. Default is None.
+        stats : loader_stats.LoaderStats
+            Optional, collects the time spent per loading stage and the bytes read and decoded, aggregated over all DataLoader 
+            workers. Default is None.
+        window : spatial_window.SpatialWindow
+            Optional, spatial window (fixed, random or center crop, and stride) of the tiles to load. The window is resolved before 
+            reading, and only the window is read and processed. A random window is drawn with seed, as the seasons. Default is None.
+        batch_loading : bool
+            Toggle loading whole batches with load_batch when the DataLoader batches, instead of one sample at a time. The DataLoader 
+            then passes the already batched output to its collate_fn, so it must be used with collate_fn of this module. Default is 
+            False, where the collate_fn of the DataLoader receives the list of samples.
 
         Returns
         -------
         torch.Tensor or dict
             If output_file_name=False, outputs a torch.Tensor. 
             If output_file_name=True, outputs a dictionary with fields 'data' and 'file_name'. 'data' is a torch.Tensor if concat=True and a dict with one field per modality, each containing a torch.Tensor if False. 'file_name' is the id of the loaded file.
+            With a window, the dictionary additionally has the field 'window', see SpatialWindow.resolve.
         """
 
         self.data_path = data_path
@@ -92,53 +171,295 @@ class E2SChallengeDataset(Dataset):
         self.concat = concat
         self.output_file_name = output_file_name
         self.shift_s2_channels = shift_s2_channels
+        self.normalize = normalize
+        self.pin_memory = pin_memory
+        self.seed = seed
+        self.epoch = 0
+        self.cache = cache
+        self.read_ahead = read_ahead
+        self.stats = stats
+        self.window = window
+        self.batch_loading = batch_loading
+        assert backend in ['zarr', 'xarray'], "backend must be 'zarr' or 'xarray'."
+        self.backend = backend
+        if normalize:
+            if moments is None:
+                moments = MODALITY_MOMENTS_SSL4EO if shift_s2_channels else MODALITY_MOMENTS
+            elif not isinstance(moments, dict):
+                moments = load_moments(moments, shift_s2_channels=shift_s2_channels)
+            assert all(m in moments for m in modalities), f"Normalization is only available for the modalities {list(moments)}."
+            self.moments = {m: (np.asarray(moments[m][0], dtype=np.float32)[:, None, None], 
+                                np.asarray(moments[m][1], dtype=np.float32)[:, None, None]) for m in modalities}
+        
+        if max_open_files is not None:
+            assert max_open_files >= len(modalities), "max_open_files must be at least the number of modalities."
+            self.store_cache = ZarrStoreCache(max_open_files)
+        else:
+            self.store_cache = None
         
-        self.samples = glob.glob(os.path.join(data_path, modalities[0], '*.zarr.zip'))
+        if index_file is not None:
+            self.sample_index = SampleIndex.load_or_build(index_file, data_path, modalities, dataset_name=dataset_name)
+            self.samples = self.sample_index
+        else:
+            self.sample_index = None
+            self.samples = glob.glob(os.path.join(data_path, modalities[0], '*.zarr.zip'))
         
 
     def __len__(self):
 
         return len(self.samples)
 
-    def __getitem__(self, idx):
-
+    def _sample_paths(self, idx):
+        if self.sample_index is not None:
+            return [os.path.join(self.data_path, self.sample_index.path(idx, modality)) for modality in self.modalities]
         sample_path = self.samples[idx]
-        file_name = os.path.splitext(os.path.basename(sample_path))[0].replace('.zarr', '')
+        return [sample_path] + [sample_path.replace(self.modalities[0], modality) for modality in self.modalities[1:]]
+
+    def file_name(self, idx):
+        """Id of sample idx, i.e. its file name without extension, as output with output_file_name=True."""
+        if self.sample_index is not None:
+            return self.sample_index.file_name(idx).replace('.zarr.zip', '')
+        return os.path.splitext(os.path.basename(self.samples[idx]))[0].replace('.zarr', '')
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch used with seed to draw different seasons in each epoch. Call before creating the DataLoader iterator."""
+        self.epoch = epoch
+
+    def set_sample_order(self, order: List[int], batch_size: int = 1):
+        """Set the order in which the sampler yields the indices in the next epoch, used to read ahead the upcoming samples."""
+        if self.read_ahead is not None:
+            self.read_ahead.set_order(order, batch_size)
+
+    def _cache_key(self, idx):
+        return SharedSampleCache.key(str(self.data_path), self.file_name(idx), self.modalities, self.dataset_name, self.backend)
+
+    def _schedule_read_ahead(self, indices):
+        """Start reading the files of the samples at indices and of the next samples this process loads, skipping cached files."""
+        cached = (lambda idx: self._cache_key(idx) in self.cache) if self.cache is not None else None
+        self.read_ahead.schedule_samples(indices, self._sample_paths, cached, self.store_cache)
+
+    def _draw_seasons(self, idx):
         if self.randomize_seasons:
-            seasons = [self.possible_seasons[ind] for ind in torch.randperm(len(self.possible_seasons)).tolist()[:self.seasons]]
-        else:
-            seasons = self.possible_seasons
-        sample_paths = [sample_path] + [sample_path.replace(self.modalities[0], modality) for modality in self.modalities[1:]]
-        data = {}
-        
+            if self.seed is None:
+                order = torch.randperm(len(self.possible_seasons)).tolist()
+            else:
+                order = np.random.default_rng([self.seed, self.epoch, idx]).permutation(len(self.possible_seasons)).tolist()
+            return [self.possible_seasons[ind] for ind in order[:self.seasons]]
+        return self.possible_seasons
+
+    def _draw_window(self, idx, array):
+        """Window of sample idx in the tiles of array, or None to read the whole tiles."""
+        if self.window is None:
+            return None
+        # A different random stream than the seasons of the sample
+        rng = np.random.default_rng([self.seed, self.epoch, idx, 1]) if self.seed is not None else None
+        return self.window.resolve(array.shape[dim_axis(array, 'y')], array.shape[dim_axis(array, 'x')], rng)
+
+    def _open_arrays(self, idx, sample_paths, stores):
+        """Open the zarr arrays of all modalities of a sample, or get their decoded values from the cache. Stores which must be closed 
+        by the caller are appended to stores."""
+        if self.cache is not None:
+            key = self._cache_key(idx)
+            with timed(self.stats, 'open'):
+                cached = self.cache.get(key)
+            if cached is not None:
+                return {m: DecodedArray(values) for m, values in zip(self.modalities, cached)}
+
+        arrays = {}
+        with timed(self.stats, 'open'):
+            for modality, sample_path in zip(self.modalities, sample_paths):
+                group = open_group(sample_path, self.read_ahead, self.store_cache, stores, self.stats)
+                arrays[modality] = group[self.dataset_name]
+
+        if self.cache is not None:
+            # Decode all seasons once, the seasons are selected from the cached values
+            with timed(self.stats, 'decode'):
+                decoded = [read_decoded(arrays[m], path, self.dataset_name, self.backend, self.store_cache) for m, path in zip(self.modalities, sample_paths)]
+            if all(values is not None for values in decoded):
+                self.cache.put(key, decoded)
+                return {m: DecodedArray(values) for m, values in zip(self.modalities, decoded)}
+        return arrays
+
+    def _output_shapes(self, arrays, n_seasons, window=None):
+        """Shape of the selected seasons (and window) of each modality."""
+        shapes = {}
+        for modality, array in arrays.items():
+            shape = list(array.shape)
+            shape[dim_axis(array, 'time')] = n_seasons
+            if window is not None:
+                for dim, window_slice in zip(['y', 'x'], window_slices(window)):
+                    axis = dim_axis(array, dim)
+                    shape[axis] = len(range(*window_slice.indices(shape[axis])))
+            shapes[modality] = shape
+        return shapes
+
+    def _read_fused(self, outs, arrays, sample_paths, seasons, window=None):
+        """Read the selected seasons (and window) of each modality into the float32 arrays in outs.
+
+        Each modality is decoded once and written straight into its preallocated output, applying the S2 shift in the 
+        same pass. Reads through xarray with backend='xarray' and for arrays which xarray would decode (masking or scaling), 
+        so that the output is always identical to xarray.
+        """
         for modality, sample_path in zip(self.modalities, sample_paths):
-            season_index = xr.DataArray(seasons, dims='time')
-            data[modality] = xr.open_zarr(sample_path).isel(time=season_index)[self.dataset_name].values
+            array = arrays[modality]
+            with timed(self.stats, 'decode'):
+                if isinstance(array, DecodedArray) or (self.backend == 'zarr' and is_stored_as_decoded(array)):
+                    selection = [slice(None)] * array.ndim
+                    selection[dim_axis(array, 'time')] = seasons
+                    if window is not None:
+                        # Only the chunks overlapping the window are read
+                        selection[dim_axis(array, 'y')], selection[dim_axis(array, 'x')] = window_slices(window)
+                    values = read_orthogonal_selection(array, selection)
+                else:
+                    import xarray as xr
+                    selection = {'time': xr.DataArray(seasons, dims='time')}
+                    if window is not None:
+                        selection['y'], selection['x'] = window_slices(window)
+                    ds = self.store_cache.dataset(sample_path) if self.store_cache is not None else xr.open_zarr(sample_path)
+                    values = ds.isel(selection)[self.dataset_name].values
+            if self.stats is not None:
+                self.stats.add('bytes_decoded', values.nbytes)
 
             # Add shift to modality, typically used to align S2 channels with SSL4EO-S12 v1.1
-            if self.shift_s2_channels and (modality in ['s2l1c', 's2l2a']):
-                data[modality] += 1000
+            # The addition is done in the stored dtype before casting, as when shifting the stored values in place.
+            with timed(self.stats, 'cast'):
+                if self.shift_s2_channels and (modality in ['s2l1c', 's2l2a']):
+                    np.add(values, 1000, out=outs[modality], casting='unsafe')
+                else:
+                    np.copyto(outs[modality], values, casting='unsafe')
+
+    def _normalize(self, outs):
+        """Normalize the float32 arrays in outs in place."""
+        for modality, out in outs.items():
+            mean, std = self.moments[modality]
+            np.subtract(out, mean, out=out)
+            np.divide(out, std, out=out)
+
+    def __getitem__(self, idx):
+
+        sample_paths = self._sample_paths(idx)
+        file_name = self.file_name(idx)
+        seasons = self._draw_seasons(idx)
+        if self.read_ahead is not None:
+            self._schedule_read_ahead([idx])
 
-        n_bands_per_modality = {m: d.shape[-3] for m, d in data.items()}
-        start_ind_of_modality = {m: n for m, n in zip(self.modalities, [0] + np.cumsum(list(n_bands_per_modality.values())).tolist())}
+        stores = []
+        try:
+            arrays = self._open_arrays(idx, sample_paths, stores)
+            window = self._draw_window(idx, arrays[self.modalities[0]])
+            shapes = self._output_shapes(arrays, len(seasons), window)
+            n_bands_per_modality = {m: shape[-3] for m, shape in shapes.items()}
+            start_ind_of_modality = {m: n for m, n in zip(self.modalities, [0] + np.cumsum(list(n_bands_per_modality.values())).tolist())}
 
-        # Concatenate data
-        data = np.concatenate(list(data.values()), axis=-3)
-        data = data.astype(np.float32) # uint16 before, but that type is not accepted by from_numpy()
+            # Read all modalities into their channel slice of a single array
+            shape = list(shapes[self.modalities[0]])
+            shape[-3] = sum(n_bands_per_modality.values())
+            data = np.empty(shape, dtype=np.float32)
+            outs = {m: data[..., start_ind_of_modality[m]: start_ind_of_modality[m] + n_bands_per_modality[m], :, :] for m in self.modalities}
+            self._read_fused(outs, arrays, sample_paths, seasons, window)
+        finally:
+            for store in stores:
+                store.close()
+
+        if self.normalize:
+            with timed(self.stats, 'normalize'):
+                self._normalize(outs)
         data = torch.from_numpy(data)
         
         # Transform
         if self.transform is not None:
-            data = self.transform(data)
+            with timed(self.stats, 'transform'):
+                data = self.transform(data)
+        if self.stats is not None:
+            self.stats.add('items')
             
         if not self.concat:
             data = {m: data[..., start_ind_of_modality[m]: start_ind_of_modality[m] + n_bands_per_modality[m], :, :] for m in self.modalities}
 
         if self.output_file_name:
+            if self.window is not None:
+                return {'data': data, 'file_name': file_name, 'window': window}
             return {'data': data, 'file_name': file_name}
         else:
             return data
 
+    def __getitems__(self, indices):
+        """Samples at indices, called by the DataLoader when batching. With batch_loading=True, the batch loaded with load_batch."""
+        if self.batch_loading:
+            return self.load_batch(indices)
+        if self.read_ahead is not None:
+            self._schedule_read_ahead(indices)
+        return [self[idx] for idx in indices]
+
+    def load_batch(self, indices):
+        """Load a batch of samples directly into preallocated batch tensors.
+
+        Returns the same output as collate_fn applied to the individual samples. With concat=True, all samples are read into one [batch_size * n_samples, n_seasons, n_channels, height, width] 
+        tensor, otherwise into one such tensor per modality. The normalization runs once per batch. The tensors are allocated in 
+        shared memory in DataLoader workers, avoiding a copy when the batch is sent to the main process, and in pinned memory 
+        if pin_memory=True in the main process. The transform is still applied to each sample, as random transforms are drawn per sample.
+        """
+        if self.read_ahead is not None:
+            self._schedule_read_ahead(indices)
+        stores = []
+        try:
+            batch = None
+            file_names, windows = [], []
+            for i, idx in enumerate(indices):
+                sample_paths = self._sample_paths(idx)
+                file_names.append(self.file_name(idx))
+                seasons = self._draw_seasons(idx)
+                arrays = self._open_arrays(idx, sample_paths, stores)
+                windows.append(self._draw_window(idx, arrays[self.modalities[0]]))
+                shapes = self._output_shapes(arrays, len(seasons), windows[-1])
+                n_per_sample = shapes[self.modalities[0]][0]
+
+                if batch is None:
+                    n_bands_per_modality = {m: shape[-3] for m, shape in shapes.items()}
+                    start_ind_of_modality = {m: n for m, n in zip(self.modalities, [0] + np.cumsum(list(n_bands_per_modality.values())).tolist())}
+                    if self.concat:
+                        shape = list(shapes[self.modalities[0]])
+                        shape[0] *= len(indices)
+                        shape[-3] = sum(n_bands_per_modality.values())
+                        batch = empty_batch(shape, self.pin_memory)
+                        batch_outs = {m: batch.numpy()[..., start_ind_of_modality[m]: start_ind_of_modality[m] + n_bands_per_modality[m], :, :] for m in self.modalities}
+                    else:
+                        batch = {m: empty_batch([shape[0] * len(indices)] + shape[1:], self.pin_memory) for m, shape in shapes.items()}
+                        batch_outs = {m: b.numpy() for m, b in batch.items()}
+
+                assert all(list(shapes[m]) == [n_per_sample] + list(batch_outs[m].shape[1:]) for m in self.modalities), "All samples in a batch must have the same shape."
+                self._read_fused({m: out[i * n_per_sample:(i + 1) * n_per_sample] for m, out in batch_outs.items()}, arrays, sample_paths, seasons, windows[-1])
+
+                while stores:
+                    stores.pop().close()
+        finally:
+            for store in stores:
+                store.close()
+
+        if self.normalize:
+            with timed(self.stats, 'normalize'):
+                self._normalize(batch_outs)
+
+        if self.transform is not None:
+            with timed(self.stats, 'transform'):
+                if self.concat:
+                    batch = torch.concat([self.transform(batch[i * n_per_sample:(i + 1) * n_per_sample]) for i in range(len(indices))], dim=0)
+                else:
+                    # The transform is applied to the concatenated modalities, as in __getitem__
+                    samples = [self.transform(torch.concat([batch[m][i * n_per_sample:(i + 1) * n_per_sample] for m in self.modalities], dim=-3)) for i in range(len(indices))]
+                    batch = {m: torch.concat([s[..., start_ind_of_modality[m]: start_ind_of_modality[m] + n_bands_per_modality[m], :, :] for s in samples], dim=0)
+                             for m in self.modalities}
+
+        if self.stats is not None:
+            self.stats.add('items', len(indices))
+
+        if self.output_file_name:
+            if self.window is not None:
+                return {'data': batch, 'file_name': file_names, 'window': windows}
+            return {'data': batch, 'file_name': file_names}
+        else:
+            return batch
+
 
 def collate_fn(batch):
     if isinstance(batch, dict) or isinstance(batch, torch.Tensor):
@@ -147,6 +468,12 @@ def collate_fn(batch):
     elif isinstance(batch, list) and isinstance(batch[0], torch.Tensor):
         # Concatenate tensors along sample dim
         return torch.concat(batch, dim=0)
+    elif isinstance(batch, list) and isinstance(batch[0], dict) and 'file_name' not in batch[0]:
+        # Concatenate each modality tensor along sample dim
+        return {
+            m: torch.concat([b[m] for b in batch], dim=0)
+            for m in batch[0].keys()
+        }
     elif isinstance(batch, list) and isinstance(batch[0], dict):
         file_names = [sample['file_name'] for sample in batch]
         data = [sample['data'] for sample in batch]
@@ -157,5 +484,7 @@ def collate_fn(batch):
                 m: torch.concat([b[m] for b in data], dim=0)
                 for m in data[0].keys()
             }
+        if 'window' in batch[0]:
+            return {'data': data, 'file_name': file_names, 'window': [sample['window'] for sample in batch]}
         return {'data': data, 'file_name': file_names}
     
\ No newline at end of file
@@ -0,0 +1,164 @@
+import os
+import json
+import numpy as np
+from torch.utils.data import DataLoader
+from typing import Callable, List
+
+from challenge_dataset import collate_fn
+from submission import SubmissionWriter
+
+
+class EmbeddingStore:
+
+    def __init__(self, store_dir: str, embedding_dim: int = 1024):
+        """Append-only store of embeddings, which survives the process being killed at any point.
+
+        The embeddings are appended as raw float32 rows to 'embeddings.bin' and their ids as lines to 'ids.txt' in
+        store_dir. After each commit, the number of committed rows is recorded atomically in 'committed.json'. Rows
+        written after the last commit, e.g. a partially written batch of a killed run, are discarded when the store is opened.
+
+        Parameters
+        ----------
+        store_dir : str, path-like
+            Folder of the store. Created if it does not exist, otherwise the committed embeddings are kept.
+        embedding_dim : int
+            Number of embedding dimensions. Must match the existing store. Default is 1024.
+        """
+        self.store_dir = store_dir
+        self.embedding_dim = embedding_dim
+        os.makedirs(store_dir, exist_ok=True)
+        self._embeddings_file = os.path.join(store_dir, 'embeddings.bin')
+        self._ids_file = os.path.join(store_dir, 'ids.txt')
+        self._commit_file = os.path.join(store_dir, 'committed.json')
+
+        self.n_rows, ids_bytes = 0, 0
+        if os.path.exists(self._commit_file):
+            with open(self._commit_file, 'r') as f:
+                commit = json.load(f)
+            if commit['embedding_dim'] != embedding_dim:
+                raise ValueError(f"""Store {store_dir} has {commit['embedding_dim']} embedding dimensions, but {embedding_dim} were requested.""")
+            self.n_rows, ids_bytes = commit['n_rows'], commit['ids_bytes']
+
+        # Discard everything after the last commit
+        for path, size in [(self._embeddings_file, self.n_rows * embedding_dim * 4), (self._ids_file, ids_bytes)]:
+            with open(path, 'ab') as f:
+                f.truncate(size)
+
+        with open(self._ids_file, 'r') as f:
+            self._ids = f.read().splitlines()
+        self._done = set(self._ids)
+        self._embeddings = open(self._embeddings_file, 'ab')
+        self._ids_writer = open(self._ids_file, 'ab')
+
+    def __len__(self):
+        return self.n_rows
+
+    def __contains__(self, sample_id):
+        return sample_id in self._done
+
+    @property
+    def ids(self):
+        """Ids of the committed embeddings, in the order in which they were appended."""
+        return list(self._ids[:self.n_rows])
+
+    def append(self, ids: List[str], embeddings):
+        """Append a batch of embeddings of shape [batch_size, embedding_dim]. They are only kept after the next commit."""
+        if hasattr(embeddings, 'detach'):
+            embeddings = embeddings.detach().cpu().numpy()
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(ids), self.embedding_dim)
+        self._embeddings.write(embeddings.tobytes())
+        self._ids_writer.write(''.join(f'{i}\n' for i in ids).encode())
+        self._ids.extend(ids)
+        self._done.update(ids)
+
+    def commit(self):
+        """Make the appended embeddings durable."""
+        for f in [self._embeddings, self._ids_writer]:
+            f.flush()
+            os.fsync(f.fileno())
+        commit = {'n_rows': len(self._ids), 'ids_bytes': self._ids_writer.tell(), 'embedding_dim': self.embedding_dim}
+        tmp_file = f'{self._commit_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(commit, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self._commit_file)
+        self.n_rows = commit['n_rows']
+
+    def embeddings(self):
+        """Committed embeddings as a read-only memory-mapped array of shape [n_rows, embedding_dim]."""
+        if self.n_rows == 0:
+            return np.zeros((0, self.embedding_dim), dtype=np.float32)
+        return np.memmap(self._embeddings_file, dtype=np.float32, mode='r', shape=(self.n_rows, self.embedding_dim))
+
+    def to_submission(self, path: str, batch_size: int = 1024, **kwargs):
+        """Write the committed embeddings to a submission file, see submission.SubmissionWriter."""
+        ids, embeddings = self.ids, self.embeddings()
+        with SubmissionWriter(path, embedding_dim=self.embedding_dim, **kwargs) as writer:
+            for start in range(0, self.n_rows, batch_size):
+                writer.write(ids[start:start + batch_size], embeddings[start:start + batch_size])
+
+    def close(self):
+        self._embeddings.close()
+        self._ids_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def run_embedding(dataset,
+                  embed_fn: Callable,
+                  store_dir: str,
+                  embedding_dim: int = 1024,
+                  batch_size: int = 16,
+                  num_workers: int = 0,
+                  commit_every: int = 1,
+                  collate_fn: Callable = collate_fn
+                 ):
+    """Embed all samples of a dataset into an EmbeddingStore, skipping the samples embedded by a previous run.
+
+    Restarting with the same store_dir after a crash only embeds the remaining samples. Embeddings which were not
+    committed when the previous run was killed are recomputed.
+
+    Parameters
+    ----------
+    dataset : E2SChallengeDataset or shards.ShardDataset
+        Dataset with output_file_name=True. Must implement file_name(idx), which gives the id of a sample without loading it.
+    embed_fn : callable
+        Function mapping the 'data' of a batch to embeddings of shape [batch_size, embedding_dim], as torch.Tensor or np.ndarray.
+    store_dir : str, path-like
+        Folder of the EmbeddingStore.
+    embedding_dim : int
+        Number of embedding dimensions. Default is 1024.
+    batch_size : int
+        Number of samples per batch. Default is 16.
+    num_workers : int
+        Number of DataLoader worker processes. Default is 0.
+    commit_every : int
+        Number of batches between commits. Default is 1.
+    collate_fn : callable
+        Collate function of the DataLoader. Defaults to challenge_dataset.collate_fn.
+
+    Returns
+    -------
+    EmbeddingStore
+        The store, closed, with the embeddings of all samples. Use to_submission to create the submission file.
+    """
+    assert dataset.output_file_name, "The dataset must output the file names, set output_file_name=True."
+
+    with EmbeddingStore(store_dir, embedding_dim=embedding_dim) as store:
+        remaining = [idx for idx in range(len(dataset)) if dataset.file_name(idx) not in store]
+        if len(remaining) > 0:
+            loader = DataLoader(dataset, batch_size=batch_size, sampler=remaining, num_workers=num_workers, collate_fn=collate_fn)
+            for ind, batch in enumerate(loader):
+                embeddings = embed_fn(batch['data'])
+                if len(embeddings) != len(batch['file_name']):
+                    raise ValueError(f"""embed_fn returned {len(embeddings)} embeddings for a batch of {len(batch['file_name'])} samples.""")
+                store.append(batch['file_name'], embeddings)
+                if (ind + 1) % commit_every == 0:
+                    store.commit()
+            store.commit()
+    return store
@@ -0,0 +1,312 @@
+"""Local linear probing of submission embeddings, to compare compressors without submitting them.
+
+The embeddings are normalized as in the evaluation, by the global mean and standard deviation of all embedding values,
+and scored by k-fold cross-validated ridge regression with a bias term. Classification label sets are fitted on one-hot
+targets and scored by accuracy, regression label sets are scored by R^2. Example, scoring two submissions:
+
+    python linear_probing.py --labels labels.csv --output scores.csv submission_a.csv submission_b.csv
+
+where labels.csv has an 'id' column and one column per label set. The scores approximate the evaluation, whose
+downstream tasks, folds and probes are not public.
+"""
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Sequence
+
+from embedding_pipeline import EmbeddingStore
+from submission import _read_submission_chunks
+
+
+DEFAULT_ALPHAS = (1e-2, 1e-1, 1.0, 10.0, 100.0, 1000.0)
+# Q_t = A_t / (dA_t + epsilon) has a maximum of 100 for A_t <= 1
+QUALITY_EPSILON = 0.01
+
+
+def csv_to_store(path: str, store_dir: str, embedding_dim: int = 1024, chunk_size: int = 10000):
+    """Convert a submission csv file to an EmbeddingStore in store_dir, which is memory-mapped by load_embeddings."""
+    columns = pd.read_csv(path, header=0, nrows=0).columns
+    if len(columns) - 1 != embedding_dim:
+        raise ValueError(f"""{embedding_dim} embedding dimensions expected, but {path} has {len(columns) - 1} dimensions.""")
+    with EmbeddingStore(store_dir, embedding_dim=embedding_dim) as store:
+        if len(store) > 0:
+            raise ValueError(f"""Store {store_dir} is not empty.""")
+        for chunk in _read_submission_chunks(path, columns, chunk_size):
+            store.append(chunk['id'].tolist(), chunk.drop(columns='id').to_numpy())
+            store.commit()
+    return store
+
+
+def load_embeddings(path: str, embedding_dim: int = 1024, store_dir: str = None):
+    """Ids and memory-mapped float32 embeddings of a submission csv file or of an EmbeddingStore folder.
+
+    A csv file is converted once to an EmbeddingStore in store_dir, by default next to the csv file, which is reused
+    as long as it is newer than the csv file.
+
+    Returns
+    -------
+    ids : list[str]
+    embeddings : np.memmap
+        Array of shape [n_samples, embedding_dim].
+    """
+    if not os.path.isdir(path):
+        store_dir = store_dir or f'{path}.store'
+        commit_file = os.path.join(store_dir, 'committed.json')
+        if not os.path.exists(commit_file) or os.path.getmtime(commit_file) < os.path.getmtime(path):
+            for name in ['embeddings.bin', 'ids.txt', 'committed.json']:
+                if os.path.exists(os.path.join(store_dir, name)):
+                    os.remove(os.path.join(store_dir, name))
+            csv_to_store(path, store_dir, embedding_dim=embedding_dim)
+        path = store_dir
+    with EmbeddingStore(path, embedding_dim=embedding_dim) as store:
+        return store.ids, store.embeddings()
+
+
+def global_moments(embeddings: np.ndarray, chunk_size: int = 8192):
+    """Mean and standard deviation over all values of the embeddings, computed in float64 chunk by chunk."""
+    total, total_sq, count = 0.0, 0.0, 0
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float64)
+        total += chunk.sum()
+        total_sq += np.square(chunk).sum()
+        count += chunk.size
+    mean = total / count
+    return mean, np.sqrt(max(total_sq / count - mean ** 2, 0.0))
+
+
+def quality_score(scores: np.ndarray):
+    """Q_t of the fold scores, i.e. mean / (std + QUALITY_EPSILON), ignoring failed (NaN) folds."""
+    return np.nanmean(scores, axis=-1) / (np.nanstd(scores, axis=-1) + QUALITY_EPSILON)
+
+
+def _targets(labels, task):
+    """Target matrix of a label set and the function scoring predictions of these targets."""
+    values = np.asarray(labels)
+    if task == 'classification':
+        classes, y = np.unique(values.reshape(len(values)), return_inverse=True)
+        def score(predictions, rows):
+            return np.mean(np.argmax(predictions, axis=-1) == y[rows], axis=-1)
+        return np.eye(len(classes))[y], score
+    assert task == 'regression', f"Unknown task {task}, must be 'classification' or 'regression'."
+    y = values.reshape(len(values), -1).astype(np.float64)
+    def score(predictions, rows):
+        residual = np.square(y[rows] - predictions).sum(axis=-2)
+        total = np.square(y[rows] - y[rows].mean(axis=0)).sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2 = np.where(total > 0, 1 - residual / total, np.nan)
+        return r2.mean(axis=-1)
+    return y, score
+
+
+def _infer_task(labels):
+    dtype = np.asarray(labels).dtype
+    return 'regression' if np.issubdtype(dtype, np.floating) else 'classification'
+
+
+def _probe(embeddings, rows, label_values, tasks, alphas, mean, std, n_folds, seed, chunk_size):
+    """Cross-validated ridge probes of label sets which label the same rows of embeddings, see evaluate_embeddings."""
+    n = len(rows)
+    # All targets side by side, so that all probes share the decomposition of each fold
+    targets, scorers, columns = [], {}, {}
+    for name, values in label_values.items():
+        y, scorers[name] = _targets(values, tasks[name])
+        columns[name] = slice(sum(t.shape[1] for t in targets), sum(t.shape[1] for t in targets) + y.shape[1])
+        targets.append(y)
+    y = np.concatenate(targets, axis=1)
+
+    folds = np.random.default_rng(seed).permutation(n) % n_folds
+    # Read the rows in file order
+    order = np.argsort(rows, kind='stable')
+
+    def normalized_chunks():
+        for start in range(0, n, chunk_size):
+            chunk = order[start:start + chunk_size]
+            x = (np.asarray(embeddings[rows[chunk]], dtype=np.float64) - mean) / std
+            yield chunk, x
+
+    # Per-fold sufficient statistics
+    d = embeddings.shape[1]
+    gram = np.zeros((n_folds, d, d))
+    x_sum = np.zeros((n_folds, d))
+    xy = np.zeros((n_folds, d, y.shape[1]))
+    for chunk, x in normalized_chunks():
+        for k in range(n_folds):
+            in_fold = folds[chunk] == k
+            xk = x[in_fold]
+            gram[k] += xk.T @ xk
+            x_sum[k] += xk.sum(axis=0)
+            xy[k] += xk.T @ y[chunk[in_fold]]
+    counts = np.bincount(folds, minlength=n_folds)
+    y_sum = np.stack([y[folds == k].sum(axis=0) for k in range(n_folds)])
+
+    # Weights of all alphas and targets per fold, from the centered Gram matrix of the training samples
+    weights = np.zeros((n_folds, d, len(alphas) * y.shape[1]))
+    biases = np.zeros((n_folds, len(alphas) * y.shape[1]))
+    for k in range(n_folds):
+        n_train = n - counts[k]
+        x_mean = (x_sum.sum(axis=0) - x_sum[k]) / n_train
+        y_mean = (y_sum.sum(axis=0) - y_sum[k]) / n_train
+        centered_gram = gram.sum(axis=0) - gram[k] - n_train * np.outer(x_mean, x_mean)
+        centered_xy = xy.sum(axis=0) - xy[k] - n_train * np.outer(x_mean, y_mean)
+        eigenvalues, eigenvectors = np.linalg.eigh(centered_gram)
+        projected = eigenvectors.T @ centered_xy
+        shrinkage = eigenvalues[:, None] + alphas[None, :]
+        # Pseudo-inverse for directions without variance, e.g. alpha=0 with fewer samples than dimensions
+        tolerance = max(eigenvalues.max(), 0.0) * d * np.finfo(np.float64).eps
+        with np.errstate(divide='ignore'):
+            shrinkage = np.where(shrinkage > tolerance, 1 / shrinkage, 0.0)
+        w = eigenvectors @ (shrinkage[:, :, None] * projected[:, None, :]).reshape(d, -1)
+        weights[k] = w
+        biases[k] = np.tile(y_mean, len(alphas)) - x_mean @ w
+
+    predictions = np.zeros((n, len(alphas), y.shape[1]))
+    for chunk, x in normalized_chunks():
+        for k in range(n_folds):
+            in_fold = folds[chunk] == k
+            predictions[chunk[in_fold]] = (x[in_fold] @ weights[k] + biases[k]).reshape(-1, len(alphas), y.shape[1])
+
+    results = []
+    for name in label_values:
+        # scores of shape [n_alphas, n_folds]
+        scores = np.stack([scorers[name](predictions[folds == k][:, :, columns[name]].transpose(1, 0, 2), folds == k)
+                           for k in range(n_folds)], axis=-1)
+        quality = quality_score(scores)
+        for i, alpha in enumerate(alphas):
+            result = {'label_set': name, 'task': tasks[name], 'alpha': alpha, 'n_samples': n, 'mean': np.nanmean(scores[i]),
+                      'std': np.nanstd(scores[i]), 'quality': quality[i], 'n_failed': int(np.isnan(scores[i]).sum())}
+            result.update({f'fold_{k}': scores[i, k] for k in range(n_folds)})
+            results.append(result)
+    return results
+
+
+def evaluate_embeddings(embeddings,
+                        labels: Dict[str, Sequence],
+                        ids: List[str] = None,
+                        tasks: Dict[str, str] = None,
+                        alphas: Sequence[float] = DEFAULT_ALPHAS,
+                        n_folds: int = 10,
+                        seed: int = 0,
+                        embedding_dim: int = 1024,
+                        chunk_size: int = 8192
+                       ):
+    """Cross-validated ridge probes of several label sets and regularization strengths, fitted together.
+
+    The embeddings are normalized by the global mean and standard deviation of all their values. For each fold, the
+    Gram matrix of the training samples is obtained from per-fold Gram matrices accumulated in a single pass over the
+    embeddings, and decomposed once. The probes of all label sets and alphas are then solved in closed form from this
+    decomposition, with an unpenalized bias. The held-out predictions are computed in a second pass. The embeddings are
+    read in chunks, so a memory-mapped file is not loaded into memory as a whole.
+
+    Parameters
+    ----------
+    embeddings : str, path-like or np.ndarray
+        Submission csv file, EmbeddingStore folder, or array of shape [n_samples, embedding_dim].
+    labels : dict
+        Label set name to labels. Either pandas Series (DataFrame for multiple regression targets) indexed by the sample
+        ids, or arrays with one entry per row of embeddings. Indexed labels must cover the same ids, and only these
+        samples are probed, while the normalization uses all embeddings. Missing labels (NaN or None) are left out of the
+        probes of their label set. Note that pandas reads integer classes with missing values as floats, which are
+        regression targets unless given in tasks.
+    ids : list[str]
+        Ids of the rows of embeddings, required for indexed labels if embeddings is an array.
+    tasks : dict
+        Label set name to 'classification' or 'regression'. By default, float labels are regression targets and all
+        other labels are classes.
+    alphas : list[float]
+        Ridge penalties, relative to the normalized embeddings. Default is DEFAULT_ALPHAS.
+    n_folds : int
+        Number of cross-validation folds. Default is 10.
+    seed : int
+        Seed of the random assignment of samples to folds. Default is 0.
+    embedding_dim : int
+        Number of embedding dimensions of a csv file or EmbeddingStore. Default is 1024.
+    chunk_size : int
+        Number of rows processed at a time. Default is 8192.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per label set and alpha, with the task, the number of labelled samples, the scores of each fold
+        (accuracy or R^2), their mean and standard deviation, the quality score and the number of failed folds.
+    """
+    if isinstance(embeddings, (str, os.PathLike)):
+        ids, embeddings = load_embeddings(embeddings, embedding_dim=embedding_dim)
+    tasks = {name: (tasks or {}).get(name) or _infer_task(values) for name, values in labels.items()}
+
+    # Rows of the labelled samples, in the order of the labels
+    first = next(iter(labels.values()))
+    if isinstance(first, (pd.Series, pd.DataFrame)):
+        if ids is None:
+            raise ValueError(f"""ids of the embeddings are required for labels indexed by id.""")
+        positions = pd.Series(np.arange(len(ids)), index=pd.Index(ids))
+        missing = first.index.difference(positions.index)
+        if len(missing) > 0:
+            raise ValueError(f"""{len(missing)} labelled samples are missing in the embeddings, e.g. {missing[0]}.""")
+        rows = positions[first.index].to_numpy()
+        label_values = {}
+        for name, values in labels.items():
+            if not first.index.sort_values().equals(values.index.sort_values()):
+                raise ValueError(f"""Label set {name} does not cover the same samples as {next(iter(labels))}.""")
+            label_values[name] = values.loc[first.index].to_numpy()
+    else:
+        rows = np.arange(len(embeddings))
+        label_values = {name: np.asarray(values) for name, values in labels.items()}
+        for name, values in label_values.items():
+            if len(values) != len(rows):
+                raise ValueError(f"""Label set {name} has {len(values)} labels for {len(rows)} embeddings.""")
+    # Samples without a label are left out of the probes of that label set. Label sets which label the same samples
+    # share the decomposition of each fold.
+    labelled = {name: ~pd.isna(values).reshape(len(values), -1).any(axis=1) for name, values in label_values.items()}
+    groups = {}
+    for name, mask in labelled.items():
+        groups.setdefault(mask.tobytes(), []).append(name)
+    for names in groups.values():
+        n_labelled = int(labelled[names[0]].sum())
+        if n_labelled < n_folds:
+            raise ValueError(f"""Label set {names[0]} has {n_labelled} labelled samples, but at least n_folds={n_folds} are required.""")
+
+    mean, std = global_moments(embeddings, chunk_size=chunk_size)
+    alphas = np.asarray(alphas, dtype=np.float64)
+    results = {}
+    for names in groups.values():
+        mask = labelled[names[0]]
+        for result in _probe(embeddings, rows[mask], {name: label_values[name][mask] for name in names}, tasks, alphas,
+                             mean, std, n_folds, seed, chunk_size):
+            results.setdefault(result['label_set'], []).append(result)
+    return pd.DataFrame([result for name in label_values for result in results[name]])
+
+
+def evaluate_submissions(paths: List[str], labels: Dict[str, Sequence], **kwargs):
+    """evaluate_embeddings of several submission files or EmbeddingStore folders, with a 'submission' column."""
+    results = []
+    for path in paths:
+        result = evaluate_embeddings(path, labels, **kwargs)
+        result.insert(0, 'submission', str(path))
+        results.append(result)
+    return pd.concat(results, ignore_index=True)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description='Score submission files by cross-validated linear probing.')
+    parser.add_argument('submissions', nargs='+', help='Submission csv files or EmbeddingStore folders.')
+    parser.add_argument('--labels', required=True, help="csv file with an 'id' column and one column per label set.")
+    parser.add_argument('--tasks', nargs='+', default=[], help='Task per label set as name=classification or name=regression.')
+    parser.add_argument('--alphas', type=float, nargs='+', default=list(DEFAULT_ALPHAS))
+    parser.add_argument('--n-folds', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--embedding-dim', type=int, default=1024)
+    parser.add_argument('--output', default=None, help='Optional csv file of the scores.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+    label_table = pd.read_csv(args.labels, dtype={'id': str}).set_index('id')
+    tasks = dict(task.split('=', 1) for task in args.tasks)
+    results = evaluate_submissions(args.submissions, {name: label_table[name] for name in label_table.columns}, tasks=tasks,
+                                   alphas=args.alphas, n_folds=args.n_folds, seed=args.seed, embedding_dim=args.embedding_dim)
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+    best = results.loc[results.groupby(['submission', 'label_set'])['quality'].idxmax()]
+    print(best[['submission', 'label_set', 'task', 'alpha', 'n_samples', 'mean', 'std', 'quality', 'n_failed']].to_string(index=False))
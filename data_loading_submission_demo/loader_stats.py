@@ -0,0 +1,201 @@
+import json
+import time
+import logging
+import threading
+import contextlib
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+
+from batching import shared_empty
+
+
+# Stages timed by the datasets: opening the zarr.zip archives (including cache lookups and waiting for read-ahead),
+# decoding the selected values, casting them to float32 (with the S2 shift), normalize=True, the transform, and the
+# collate function wrapped with LoaderStats.timed. 'wait' is the time the training loop waits for batches, see LoaderStats.iterate.
+STAGES = ('open', 'decode', 'cast', 'normalize', 'transform', 'collate', 'wait')
+# Counters: dataset items loaded, size of the zarr.zip archives opened, and bytes of decoded values
+COUNTERS = ('items', 'bytes_read', 'bytes_decoded')
+
+logger = logging.getLogger(__name__)
+
+_DISABLED = contextlib.nullcontext()
+
+
+def timed(stats, stage: str):
+    """Context manager timing stage in stats, or doing nothing if stats is None."""
+    return _DISABLED if stats is None else stats.time(stage)
+
+
+def archive_bytes(store):
+    """Size of the members of an opened zarr.zip archive, from its central directory without reading the archive."""
+    return sum(info.compress_size for info in store.zf.infolist())
+
+
+class _StageTimer:
+    __slots__ = ('stats', 'column', 'start')
+
+    def __init__(self, stats, column):
+        self.stats = stats
+        self.column = column
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        row = self.stats._row()
+        row[self.column] += 1
+        row[self.column + 1] += time.perf_counter() - self.start
+
+
+class _TimedFunction:
+    """Picklable wrapper timing a function, e.g. the collate function in DataLoader workers."""
+
+    def __init__(self, stats, fn, stage):
+        self.stats = stats
+        self.fn = fn
+        self.stage = stage
+
+    def __call__(self, *args, **kwargs):
+        with self.stats.time(self.stage):
+            return self.fn(*args, **kwargs)
+
+
+class LoaderStats:
+
+    def __init__(self, max_workers: int = 64):
+        """Per-stage timers and byte counters of the loading pipeline, aggregated over the main process and all DataLoader workers.
+
+        Pass to E2SChallengeDataset or SSL4EOS12Dataset with stats=. Each process adds its timings to its own row of a
+        table in shared memory: the main process to the first row and DataLoader worker w to row w + 1. The rows are
+        summed by summary in any process, e.g. during training. Use a separate LoaderStats for DataLoaders which iterate
+        at the same time, as their workers would share rows. Without stats, the datasets only check for None at each stage.
+
+        The timed stages are listed in STAGES and the counters in COUNTERS. Stages run in DataLoader workers in parallel,
+        so their total time can exceed the wall time. The time the training loop waits for batches is only timed when
+        iterating with iterate, and the collate function only when wrapped with timed.
+
+        Parameters
+        ----------
+        max_workers : int
+            Maximum number of DataLoader workers. Workers with a higher id share rows. Default is 64.
+
+        Examples
+        --------
+        >>> stats = LoaderStats()
+        >>> dataset = E2SChallengeDataset(data_path, modalities=modalities, stats=stats)
+        >>> loader = DataLoader(dataset, batch_size=16, num_workers=4, collate_fn=stats.timed(collate_fn))
+        >>> stats.start_logging(interval=60)
+        >>> for batch in stats.iterate(loader):
+        ...     train_step(batch)
+        >>> stats.summary()['stages']['decode']
+        """
+        self.max_workers = max_workers
+        self._n_columns = 2 * len(STAGES) + len(COUNTERS)
+        self._table = shared_empty((max_workers + 1) * self._n_columns, torch.float64).view(max_workers + 1, -1)
+        # Wall time of the last reset
+        self._start = shared_empty(1, torch.float64)
+        self._columns = {stage: 2 * i for i, stage in enumerate(STAGES)}
+        self._columns.update({counter: 2 * len(STAGES) + i for i, counter in enumerate(COUNTERS)})
+        self._logging = None
+        self.reset()
+        self._open()
+
+    def _open(self):
+        self._table_np = self._table.numpy()
+        self._start_np = self._start.numpy()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['_table_np', '_start_np', '_logging']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._logging = None
+        self._open()
+
+    def _row(self):
+        info = get_worker_info()
+        return self._table_np[0 if info is None else 1 + info.id % self.max_workers]
+
+    def time(self, stage: str):
+        """Context manager adding a call and its duration to stage."""
+        return _StageTimer(self, self._columns[stage])
+
+    def add(self, counter: str, value: int = 1):
+        """Add value to counter."""
+        self._row()[self._columns[counter]] += value
+
+    def timed(self, fn, stage: str = 'collate'):
+        """fn, e.g. the collate function of a DataLoader, with its calls timed as stage."""
+        return _TimedFunction(self, fn, stage)
+
+    def iterate(self, iterable):
+        """Iterate over iterable, e.g. a DataLoader, timing the wait for each item as the stage 'wait'."""
+        iterator = iter(iterable)
+        while True:
+            with self.time('wait'):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def reset(self):
+        """Set all timers and counters to zero. Must not be called while DataLoader workers are loading."""
+        self._table[:] = 0
+        self._start[0] = time.time()
+
+    def summary(self, per_worker: bool = False):
+        """Aggregated timings and counters since the last reset.
+
+        Returns
+        -------
+        dict
+            'elapsed' wall time in seconds, per stage the number of 'calls', total 'seconds' and 'mean_ms' per call, the
+            counters, and the throughput in 'items_per_second' and 'mb_read_per_second'. With per_worker, additionally
+            the stages and counters of each process with any activity under 'workers', keyed by 'main' or the worker id.
+        """
+        table = self._table_np.copy()
+        elapsed = time.time() - float(self._start_np[0])
+
+        def aggregate(row):
+            stages = {}
+            for stage in STAGES:
+                calls, seconds = row[self._columns[stage]], row[self._columns[stage] + 1]
+                stages[stage] = {'calls': int(calls), 'seconds': float(seconds), 'mean_ms': float(1000 * seconds / calls) if calls > 0 else 0.0}
+            return {'stages': stages, **{counter: int(row[self._columns[counter]]) for counter in COUNTERS}}
+
+        result = {'elapsed': elapsed, **aggregate(table.sum(axis=0))}
+        result['items_per_second'] = result['items'] / elapsed if elapsed > 0 else 0.0
+        result['mb_read_per_second'] = result['bytes_read'] / 2 ** 20 / elapsed if elapsed > 0 else 0.0
+        if per_worker:
+            result['workers'] = {('main' if i == 0 else i - 1): aggregate(row) for i, row in enumerate(table) if np.any(row != 0)}
+        return result
+
+    def log(self, per_worker: bool = False):
+        """Log the summary as a single json line at level INFO."""
+        logger.info(json.dumps({'loader_stats': self.summary(per_worker=per_worker)}))
+
+    def start_logging(self, interval: float = 60.0, per_worker: bool = False):
+        """Log the summary every interval seconds from a background thread of this process, until stop_logging."""
+        self.stop_logging()
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.log(per_worker=per_worker)
+
+        thread = threading.Thread(target=run, name='loader_stats', daemon=True)
+        thread.start()
+        self._logging = (stop, thread)
+
+    def stop_logging(self):
+        if self._logging is not None:
+            stop, thread = self._logging
+            stop.set()
+            thread.join()
+            self._logging = None
@@ -0,0 +1,88 @@
+import torch
+from typing import List
+
+
+# Modalities and number of channels of the challenge data, in the order of the notebooks
+MODALITY_CHANNELS = {'s2l1c': 13, 's2l2a': 12, 's1': 2}
+
+
+def _interpolation_matrix(in_size, out_size, dtype=torch.float64):
+    """Matrix of shape [out_size, in_size] of linear interpolation weights, as scipy.ndimage.zoom with order=1."""
+    # zoom maps output coordinate o to input coordinate o * (in_size - 1) / (out_size - 1)
+    coords = torch.arange(out_size, dtype=torch.float64) * ((in_size - 1) / (out_size - 1) if out_size > 1 else 0)
+    lower = coords.floor().long().clamp(max=in_size - 1)
+    upper = (lower + 1).clamp(max=in_size - 1)
+    frac = coords - lower
+    weights = torch.zeros(out_size, in_size, dtype=torch.float64)
+    rows = torch.arange(out_size)
+    weights[rows, lower] += 1 - frac
+    weights[rows, upper] += frac
+    return weights.to(dtype)
+
+
+def bilinear_downsample(data: torch.Tensor, size: int = 8):
+    """Bilinear interpolation of the last two dimensions to size x size, equal to scipy.ndimage.zoom with order=1.
+
+    Parameters
+    ----------
+    data : torch.Tensor
+        Tensor of shape [..., height, width].
+    size : int
+        Output height and width. Default is 8.
+
+    Returns
+    -------
+    torch.Tensor
+        Tensor of shape [..., size, size], in the floating point dtype of data (float32 for integer data).
+    """
+    if not data.is_floating_point():
+        data = data.to(torch.float32)
+    weights_y = _interpolation_matrix(data.shape[-2], size, dtype=data.dtype)
+    weights_x = _interpolation_matrix(data.shape[-1], size, dtype=data.dtype)
+    return torch.matmul(torch.matmul(weights_y, data), weights_x.T)
+
+
+def mean_embedding(data, modalities: List[str] = None, size: int = 8):
+    """Batched version of the "mean" baseline embedding of baseline_compression_mean.ipynb.
+
+    Bilinearly downsamples all channels to size x size, then averages B01 to B09 of S2L1C and S2L2A, B11 and B12 of
+    S2L1C and S2L2A, and the S1 channels, which together with B10 gives 4 channels. Equal to the embed function of the
+    notebook applied to each sample, within float tolerance.
+
+    Parameters
+    ----------
+    data : torch.Tensor, np.ndarray or dict
+        Batch of shape [batch_size, n_seasons, n_channels, height, width] with the modalities concatenated, as loaded by
+        E2SChallengeDataset(concat=True), or a dict with one such batch per modality, as loaded with concat=False.
+    modalities : list[str]
+        Order of the modalities in the concatenated data. Defaults to ['s2l1c', 's2l2a', 's1'].
+    size : int
+        Height and width after downsampling. Default is 8, giving 1024 element embeddings for 4 seasons.
+
+    Returns
+    -------
+    torch.Tensor
+        Embeddings of shape [batch_size, n_seasons * 4 * size * size].
+    """
+    if isinstance(data, dict):
+        data = {m: torch.as_tensor(d) for m, d in data.items()}
+    else:
+        data = torch.as_tensor(data)
+        modalities = modalities or list(MODALITY_CHANNELS.keys())
+        data = dict(zip(modalities, torch.split(data, [MODALITY_CHANNELS[m] for m in modalities], dim=-3)))
+
+    rescaled_mod = {m: bilinear_downsample(d, size) for m, d in data.items()}
+
+    # Calculate mean of correlated channels.
+    b1_b9 = torch.mean(torch.concat((rescaled_mod['s2l1c'][:, :, 0:9, :, :],
+                                     rescaled_mod['s2l2a'][:, :, 0:9, :, :]), dim=2),
+                       dim=2, keepdim=True)
+    b10 = rescaled_mod['s2l1c'][:, :, 9:10, :, :]
+    b11_b12 = torch.mean(torch.concat((rescaled_mod['s2l1c'][:, :, 10:, :, :],
+                                       rescaled_mod['s2l2a'][:, :, 10:, :, :]), dim=2),
+                         dim=2, keepdim=True)
+    s1 = torch.mean(rescaled_mod['s1'], dim=2, keepdim=True)
+
+    # Concatenate aggregated channels and flatten each sample
+    emb = torch.concat((b1_b9, b10, b11_b12, s1), dim=2)
+    return emb.reshape(emb.shape[0], -1)
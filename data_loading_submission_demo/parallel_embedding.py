@@ -0,0 +1,80 @@
+import numpy as np
+import torch
+from typing import Callable, List
+
+from process_pool import map_bounded, worker_state
+
+
+def _embed_indices(rows, indices):
+    """Load and embed the samples at indices, writing each embedding into the given row of the shared output."""
+    dataset, embed_fn, embeddings = worker_state['dataset'], worker_state['embed_fn'], worker_state['embeddings']
+    file_names = []
+    for row, idx in zip(rows, indices):
+        sample = dataset[idx]
+        emb = embed_fn(sample['data'])
+        if hasattr(emb, 'detach'):
+            emb = emb.detach().cpu()
+        embeddings[row] = torch.as_tensor(np.asarray(emb, dtype=np.float32).reshape(-1))
+        file_names.append(sample['file_name'])
+    return rows, file_names
+
+
+def embed_parallel(dataset,
+                   embed_fn: Callable,
+                   embedding_dim: int = 1024,
+                   n_workers: int = 4,
+                   chunk_size: int = 8,
+                   max_in_flight: int = None,
+                   indices: List[int] = None,
+                   mp_context: str = None,
+                   torch_threads: int = 1
+                  ):
+    """Embed a dataset with a pool of worker processes which both load and embed the samples.
+
+    Replaces mean_embedding_parallel in baseline_compression_mean.ipynb. Each worker receives a copy of the dataset
+    and embed_fn once, then loads and embeds chunks of sample indices. The embeddings are written into a shared memory
+    tensor at their position in indices, so only the file names are sent back and the output order does not depend
+    on the order in which the chunks complete. At most max_in_flight chunks are submitted at a time, which bounds the
+    memory use independently of the dataset size.
+
+    Parameters
+    ----------
+    dataset : E2SChallengeDataset or shards.ShardDataset
+        Dataset with output_file_name=True.
+    embed_fn : callable
+        Function mapping the 'data' of a single sample to its embedding of embedding_dim values. With the 'spawn' or
+        'forkserver' contexts, it must be importable, i.e. not defined in a notebook.
+    embedding_dim : int
+        Number of embedding dimensions. Default is 1024.
+    n_workers : int
+        Number of worker processes. Default is 4.
+    chunk_size : int
+        Number of samples per task sent to a worker. Default is 8.
+    max_in_flight : int
+        Maximum number of submitted but unfinished chunks. Defaults to 2 * n_workers.
+    indices : list[int]
+        Optional, indices of the samples to embed. Defaults to all samples.
+    mp_context : str
+        Multiprocessing start method, e.g. 'fork' or 'spawn'. Defaults to the platform default.
+    torch_threads : int
+        Number of torch threads per worker. Default is 1, to not oversubscribe the cores.
+
+    Returns
+    -------
+    tuple[list[str], np.ndarray]
+        File names and embeddings of shape [len(indices), embedding_dim], in the order of indices.
+    """
+    assert dataset.output_file_name, "The dataset must output the file names, set output_file_name=True."
+    if indices is None:
+        indices = list(range(len(dataset)))
+
+    embeddings = torch.empty(len(indices), embedding_dim, dtype=torch.float32).share_memory_()
+    file_names = [None] * len(indices)
+    chunks = ((range(i, min(i + chunk_size, len(indices))), indices[i:i + chunk_size]) for i in range(0, len(indices), chunk_size))
+    state = {'dataset': dataset, 'embed_fn': embed_fn, 'embeddings': embeddings}
+    for rows, names in map_bounded(_embed_indices, chunks, state, n_workers=n_workers, max_in_flight=max_in_flight,
+                                   mp_context=mp_context, torch_threads=torch_threads):
+        for row, name in zip(rows, names):
+            file_names[row] = name
+
+    return file_names, embeddings.numpy()
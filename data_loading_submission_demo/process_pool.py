@@ -0,0 +1,70 @@
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable
+
+
+# State of each worker process of map_bounded, e.g. its copy of the dataset
+worker_state = {}
+
+
+def _init_worker(state, torch_threads):
+    if torch_threads is not None:
+        torch.set_num_threads(torch_threads)
+    worker_state.update(state)
+
+
+def map_bounded(fn: Callable,
+                tasks: Iterable[tuple],
+                state: dict = None,
+                n_workers: int = 4,
+                max_in_flight: int = None,
+                mp_context: str = None,
+                torch_threads: int = None
+               ):
+    """Run fn on each task in a pool of worker processes, with a bounded number of tasks submitted at a time.
+
+    Each worker receives state once, in worker_state of this module, so that large objects such as the dataset are not
+    sent with every task. Tasks are taken from the iterable only as earlier tasks complete, which bounds the memory use
+    independently of the number of tasks.
+
+    Parameters
+    ----------
+    fn : callable
+        Module-level function called as fn(*task) in the workers, reading the state from worker_state.
+    tasks : iterable[tuple]
+        Arguments of each call, e.g. a generator of chunks of sample indices.
+    state : dict
+        Optional, state of each worker, e.g. {'dataset': dataset}. Must be picklable with the 'spawn' or 'forkserver' contexts.
+    n_workers : int
+        Number of worker processes. Default is 4.
+    max_in_flight : int
+        Maximum number of submitted but unfinished tasks. Defaults to 2 * n_workers.
+    mp_context : str
+        Multiprocessing start method, e.g. 'fork' or 'spawn'. Defaults to the platform default.
+    torch_threads : int
+        Optional, number of torch threads per worker. Default is None, where torch chooses.
+
+    Yields
+    ------
+    object
+        Return value of each call, in the order in which the tasks complete.
+    """
+    if max_in_flight is None:
+        max_in_flight = 2 * n_workers
+    tasks = iter(tasks)
+    context = mp.get_context(mp_context)
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=_init_worker,
+                             initargs=(state or {}, torch_threads)) as executor:
+        in_flight = set()
+        while True:
+            # Keep at most max_in_flight tasks submitted
+            for task in tasks:
+                in_flight.add(executor.submit(fn, *task))
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
@@ -0,0 +1,210 @@
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import get_worker_info
+from typing import Callable, List
+
+from loader_stats import archive_bytes
+from store_cache import open_zarr_zip
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class ReadAhead:
+
+    def __init__(self, depth: int = 8, max_bytes: int = 512 * 2 ** 20, n_threads: int = 4):
+        """Background reads of the zarr.zip files of upcoming samples, for storage with a high latency such as network file systems.
+
+        Pass to E2SChallengeDataset or SSL4EOS12Dataset with read_ahead=. When a sample or batch is loaded, the files of
+        all its modalities, and of the next depth samples this process will load, are read in a pool of threads while the
+        previous files are decoded. The bytes are handed to zarr as in-memory archives, so each file is read with a few
+        large sequential reads instead of one read per zarr chunk. Arrays which are read through xarray are still read
+        from disk.
+
+        With max_open_files, the archives kept open in the dataset's store cache are opened from disk, not on the bytes
+        read ahead, since the cache holds its archives for longer than max_bytes accounts for. The bytes are dropped when
+        the archive is opened, so the read ahead then only warms the operating system's file cache, and files which are
+        already open in the cache are not read ahead.
+
+        The upcoming samples are known from the order set with set_order, which LocalityAwareSampler.set_epoch sets through
+        the dataset. Create the sampler with the batch_size and num_workers of the DataLoader, so that each DataLoader worker
+        reads ahead its own batches. Without an order, only the samples of the current batch are read ahead.
+
+        At most max_bytes of files are buffered per process. Files which do not fit are read when they are needed instead,
+        and files which were read ahead but not used, e.g. as the order changed, are dropped. Each process (DataLoader
+        worker) has its own threads and buffer: the reader is pickled without them.
+
+        Parameters
+        ----------
+        depth : int
+            Number of samples after the current sample or batch which are read ahead. Default is 8.
+        max_bytes : int
+            Maximum number of bytes of files read ahead and not yet used, per process. Default is 512 MB.
+        n_threads : int
+            Number of reading threads per process. Default is 4.
+        """
+        assert isinstance(depth, int) and depth >= 0, "depth must be a non-negative integer."
+        assert isinstance(n_threads, int) and n_threads > 0, "n_threads must be a positive integer."
+        self.depth = depth
+        self.max_bytes = int(max_bytes)
+        self.n_threads = n_threads
+        self._order = None
+        self._batch_size = 1
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._executor = None
+        # Path to the future of its read, in the order in which the files are used
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._reserved = 0
+        self._sequence = None
+
+    def __getstate__(self):
+        return {'depth': self.depth, 'max_bytes': self.max_bytes, 'n_threads': self.n_threads,
+                '_order': self._order, '_batch_size': self._batch_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            # Threads are not inherited by forked DataLoader workers
+            self._reset()
+
+    def set_order(self, order: List[int], batch_size: int = 1):
+        """Indices in the order in which the sampler yields them, split into batches of batch_size by the DataLoader."""
+        self._order = np.asarray(order, dtype=np.int64)
+        self._batch_size = batch_size
+        self._sequence = None
+
+    def upcoming(self, idx: int):
+        """Up to depth indices which this process loads after idx, according to the order."""
+        if self._order is None or self.depth == 0:
+            return []
+        self._check_process()
+        if self._sequence is None:
+            # The DataLoader sends the batches to its workers in turn
+            info = get_worker_info()
+            worker_id, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+            n_batches = -(-len(self._order) // self._batch_size)
+            batches = [self._order[b * self._batch_size:(b + 1) * self._batch_size] for b in range(worker_id, n_batches, num_workers)]
+            self._sequence = np.concatenate(batches) if batches else self._order[:0]
+            self._positions = {}
+            for position, i in enumerate(self._sequence.tolist()):
+                self._positions.setdefault(i, position)
+        position = self._positions.get(int(idx))
+        if position is None:
+            return []
+        return self._sequence[position + 1:position + 1 + self.depth].tolist()
+
+    def schedule(self, paths: List[str]):
+        """Start reading the files at paths, in the order in which they will be used. Files already scheduled are not read again."""
+        self._check_process()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.n_threads, thread_name_prefix='read_ahead')
+        for path in paths:
+            path = str(path)
+            if path not in self._pending:
+                self._pending[path] = self._executor.submit(self._fetch, path)
+
+    def schedule_samples(self, indices: List[int], sample_paths: Callable, cached: Callable = None, store_cache=None):
+        """Start reading the files of the samples at indices and of the next depth samples this process loads.
+
+        Parameters
+        ----------
+        indices : list[int]
+            Indices of the sample or batch which is loaded now.
+        sample_paths : callable
+            Function returning the paths of the files of a sample index.
+        cached : callable
+            Optional, function returning True for sample indices which are read from a cache, whose files are skipped.
+        store_cache : store_cache.ZarrStoreCache
+            Optional, cache of opened archives. Files which are already open are skipped.
+        """
+        paths = []
+        for idx in list(indices) + self.upcoming(indices[-1]):
+            if cached is not None and cached(idx):
+                continue
+            paths.extend(p for p in sample_paths(idx) if store_cache is None or p not in store_cache)
+        self.schedule(paths)
+
+    def _fetch(self, path):
+        """Content and reserved size of the file, or None if it does not fit into max_bytes or can not be read."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            # Opening the file when it is used raises the error
+            return None, 0
+        with self._lock:
+            if self._reserved + size > self.max_bytes:
+                return None, 0
+            self._reserved += size
+        try:
+            return _read_file(path), size
+        except OSError:
+            self._release(size)
+            return None, 0
+
+    def _release(self, size):
+        with self._lock:
+            self._reserved -= size
+
+    def _drop(self, future):
+        if not future.cancel():
+            future.add_done_callback(lambda f: self._release(f.result()[1]))
+
+    def take(self, path: str):
+        """Content of the file at path if it was read ahead, waiting for a read in progress, otherwise None.
+
+        Files which were scheduled before path and not taken are dropped.
+        """
+        self._check_process()
+        path = str(path)
+        if path not in self._pending:
+            return None
+        while True:
+            scheduled_path, future = self._pending.popitem(last=False)
+            if scheduled_path == path:
+                break
+            self._drop(future)
+        data, size = future.result()
+        self._release(size)
+        return data
+
+    def close(self):
+        """Drop all files read ahead and stop the threads."""
+        self._check_process()
+        while self._pending:
+            self._drop(self._pending.popitem()[1])
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def open_group(path: str, read_ahead: ReadAhead = None, store_cache=None, stores: list = None, stats=None):
+    """Root zarr group of the zarr.zip file at path, as opened by the datasets.
+
+    The archive is opened on the bytes read ahead by read_ahead, if available. With store_cache, the archive is kept open
+    there and is opened from disk, so that no bytes read ahead are held outside of the max_bytes of read_ahead. Otherwise
+    its store is appended to stores and must be closed by the caller. The size of newly opened archives is added to
+    'bytes_read' of the LoaderStats stats, if given.
+    """
+    data = read_ahead.take(path) if read_ahead is not None else None
+    if store_cache is not None:
+        opened = path not in store_cache
+        group = store_cache.group(path)
+    else:
+        opened = True
+        store, group = open_zarr_zip(path, data=data)
+        stores.append(store)
+    if opened and stats is not None:
+        stats.add('bytes_read', archive_bytes(group.chunk_store))
+    return group
@@ -0,0 +1,276 @@
+import hashlib
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from typing import List
+
+from batching import shared_empty
+from store_cache import DEFAULT_DIMS, is_stored_as_decoded
+
+
+# Dtypes which can be cached, identified by their position
+_DTYPES = [np.dtype(t) for t in ('u1', 'i1', 'u2', 'i2', 'u4', 'i4', 'u8', 'i8', 'f2', 'f4', 'f8', '?')]
+_MAX_ARRAYS = 8
+_MAX_NDIM = 6
+_ALIGNMENT = 64
+
+# Columns of the slot tables. The layout holds dtype, ndim and shape of each array of the entry.
+_KEY, _VERSION, _LAST_USED, _N_ARRAYS, _LAYOUT = 0, 1, 2, 3, 4
+_ROW_SIZE = _LAYOUT + _MAX_ARRAYS * (2 + _MAX_NDIM)
+_ROW_BYTES = _ROW_SIZE * np.dtype(np.int64).itemsize
+_EMPTY, _WRITING = -1, -2
+
+
+def _aligned(nbytes):
+    return -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+
+
+class _Tier:
+    """Fixed-size slots in a byte buffer, which starts with the slot table. The buffer is shared memory or a memory-mapped file."""
+
+    def __init__(self, buffer, max_entries=None):
+        self.buffer = buffer
+        self.max_entries = max_entries
+        self.layout(0)
+
+    def layout(self, slot_bytes):
+        """Split the buffer into the slot table and as many slots of slot_bytes as fit, if slot_bytes changed."""
+        if getattr(self, 'slot_bytes', None) == slot_bytes:
+            return
+        n_slots = max(len(self.buffer) - _ALIGNMENT, 0) // (slot_bytes + _ROW_BYTES) if slot_bytes > 0 else 0
+        if self.max_entries is not None:
+            n_slots = min(n_slots, self.max_entries)
+        self.table = self.buffer[:n_slots * _ROW_BYTES].view(np.int64).reshape(n_slots, _ROW_SIZE)
+        self.offset = _aligned(n_slots * _ROW_BYTES)
+        self.slot_bytes = slot_bytes
+
+    def find(self, key):
+        slots = np.flatnonzero(self.table[:, _KEY] == key)
+        return int(slots[0]) if len(slots) > 0 else None
+
+    def victim(self):
+        """Empty slot, or else the least recently used slot which is not being written."""
+        keys = self.table[:, _KEY]
+        if len(keys) == 0:
+            return None
+        empty = np.flatnonzero(keys == _EMPTY)
+        if len(empty) > 0:
+            return int(empty[0])
+        last_used = np.where(keys >= 0, self.table[:, _LAST_USED], np.iinfo(np.int64).max)
+        slot = int(np.argmin(last_used))
+        return slot if keys[slot] >= 0 else None
+
+    def read(self, slot, layout):
+        arrays, offset = [], self.offset + slot * self.slot_bytes
+        for i in range(layout[0]):
+            dtype_code, ndim = layout[1 + i * (2 + _MAX_NDIM)], layout[2 + i * (2 + _MAX_NDIM)]
+            shape = tuple(layout[3 + i * (2 + _MAX_NDIM):3 + i * (2 + _MAX_NDIM) + ndim])
+            dtype = _DTYPES[dtype_code]
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            arrays.append(np.frombuffer(self.buffer[offset:offset + nbytes], dtype=dtype).reshape(shape).copy())
+            offset += _aligned(nbytes)
+        return arrays
+
+    def write(self, slot, arrays):
+        offset = self.offset + slot * self.slot_bytes
+        for array in arrays:
+            self.buffer[offset:offset + array.nbytes] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+            offset += _aligned(array.nbytes)
+
+
+class SharedSampleCache:
+
+    def __init__(self,
+                 max_bytes: int,
+                 spill_file: str = None,
+                 spill_bytes: int = 0,
+                 max_entries: int = None
+                ):
+        """Cache of decoded samples in shared memory, shared by all DataLoader workers and kept across epochs.
+
+        Create the cache in the main process and pass it to E2SChallengeDataset or SSL4EOS12Dataset with cache=. The
+        cache holds the decoded arrays of each file, with all seasons, in their stored dtype. The season selection,
+        S2 shift, normalization and transforms are applied after each lookup, so the outputs are the same as without
+        the cache. Entries are kept in fixed-size slots: the first cached file sets the slot size, and files which
+        do not fit are not cached. The slot table is stored at the start of each tier and laid out when the slot size
+        is set, so each tier holds as many entries as fit into its bytes. When the cache is full, the least recently
+        used entry is evicted, or moved to spill_file if given, e.g. a file on a local SSD.
+
+        The memory is allocated in /dev/shm, which must be large enough, e.g. the --shm-size of a docker container.
+
+        Parameters
+        ----------
+        max_bytes : int
+            Size of the shared memory arena in bytes.
+        spill_file : str, path-like
+            Optional, file used as a second, memory-mapped cache tier for entries evicted from shared memory. Overwritten.
+        spill_bytes : int
+            Size of spill_file in bytes. Default is 0.
+        max_entries : int
+            Optional, maximum number of entries per tier. Defaults to as many entries as fit into max_bytes and spill_bytes, respectively.
+        """
+        self.max_bytes = int(max_bytes)
+        self.spill_file = spill_file
+        self.spill_bytes = int(spill_bytes) if spill_file is not None else 0
+        self.max_entries = max_entries
+        # A lock of the spawn context can be passed to workers of any start method
+        self._lock = mp.get_context('spawn').Lock()
+        # Slot size and the counter used for the least recently used order
+        self._header = shared_empty(2, torch.int64).zero_()
+        self._ram_data = shared_empty(self.max_bytes, torch.uint8)
+        if self.spill_bytes > 0:
+            with open(spill_file, 'wb') as f:
+                f.truncate(self.spill_bytes)
+        self._open()
+
+    def _open(self):
+        self._header_np = self._header.numpy()
+        self._ram = _Tier(self._ram_data.numpy(), self.max_entries)
+        if self.spill_bytes > 0:
+            self._spill = _Tier(np.memmap(self.spill_file, dtype=np.uint8, mode='r+', shape=(self.spill_bytes,)), self.max_entries)
+        else:
+            self._spill = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ['_header_np', '_ram', '_spill']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    @staticmethod
+    def key(*parts):
+        """Cache key of a file, e.g. of its file name and the loaded modalities."""
+        digest = hashlib.blake2b(repr(parts).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') & (2 ** 63 - 1)
+
+    def _tiers(self):
+        """Tiers laid out for the current slot size, which other processes may have set or cleared."""
+        slot_bytes = int(self._header_np[0])
+        tiers = [tier for tier in [self._ram, self._spill] if tier is not None]
+        for tier in tiers:
+            tier.layout(slot_bytes)
+        return tiers
+
+    def _tick(self):
+        self._header_np[1] += 1
+        return int(self._header_np[1])
+
+    def get(self, key: int):
+        """Cached arrays of key, or None."""
+        for tier in self._tiers():
+            with self._lock:
+                slot = tier.find(key)
+                if slot is None:
+                    continue
+                version = tier.table[slot, _VERSION]
+                tier.table[slot, _LAST_USED] = self._tick()
+                layout = tier.table[slot, _N_ARRAYS:].copy()
+            arrays = tier.read(slot, layout)
+            if tier.table[slot, _VERSION] != version:
+                # Evicted while reading
+                return None
+            if tier is self._spill:
+                # Move back to shared memory
+                self.put(key, arrays)
+            return arrays
+        return None
+
+    def put(self, key: int, arrays: List[np.ndarray]):
+        """Cache arrays under key. Returns False if they can not be cached."""
+        if len(arrays) > _MAX_ARRAYS or any(a.dtype not in _DTYPES or a.ndim > _MAX_NDIM for a in arrays):
+            return False
+        nbytes = sum(_aligned(a.nbytes) for a in arrays)
+        layout = np.zeros(_ROW_SIZE - _N_ARRAYS, dtype=np.int64)
+        layout[0] = len(arrays)
+        for i, a in enumerate(arrays):
+            start = 1 + i * (2 + _MAX_NDIM)
+            layout[start:start + 2 + a.ndim] = [_DTYPES.index(a.dtype), a.ndim, *a.shape]
+        return self._put(self._ram, key, arrays, layout, nbytes)
+
+    def _put(self, tier, key, arrays, layout, nbytes):
+        with self._lock:
+            if self._header_np[0] == 0:
+                # The first entry sets the slot size, which lays out the slot tables
+                self._header_np[0] = nbytes
+                for t in self._tiers():
+                    t.table[:] = 0
+                    t.table[:, _KEY] = _EMPTY
+            else:
+                self._tiers()
+            if nbytes > tier.slot_bytes:
+                return False
+            if tier.find(key) is not None:
+                return True
+            slot = tier.victim()
+            if slot is None:
+                return False
+            evicted_key, evicted_layout = int(tier.table[slot, _KEY]), tier.table[slot, _N_ARRAYS:].copy()
+            tier.table[slot, _KEY] = _WRITING
+            tier.table[slot, _VERSION] += 1
+
+        if evicted_key >= 0 and tier is self._ram and self._spill is not None:
+            # The evicted entry is intact until the slot is written
+            self._put(self._spill, evicted_key, self._ram.read(slot, evicted_layout), evicted_layout, nbytes)
+        tier.write(slot, arrays)
+
+        with self._lock:
+            tier.table[slot, _N_ARRAYS:] = layout
+            tier.table[slot, _LAST_USED] = self._tick()
+            tier.table[slot, _KEY] = key
+        return True
+
+    def __contains__(self, key: int):
+        """Whether key is cached. Without locking, the entry may be evicted before it is read."""
+        return any(tier.find(key) is not None for tier in self._tiers())
+
+    def __len__(self):
+        return sum(int((tier.table[:, _KEY] >= 0).sum()) for tier in self._tiers())
+
+    def clear(self):
+        """Remove all entries. Must not be called while DataLoader workers use the cache."""
+        with self._lock:
+            # The next entry sets the slot size and lays out the slot tables again
+            self._header_np[0] = 0
+
+
+class DecodedArray:
+    """Decoded values of a zarr array with the dimensions DEFAULT_DIMS, used by the datasets in place of the zarr array."""
+
+    fill_value = None
+
+    def __init__(self, values: np.ndarray):
+        self.values = values
+        self.attrs = {'_ARRAY_DIMENSIONS': list(DEFAULT_DIMS)}
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def ndim(self):
+        return self.values.ndim
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    def get_basic_selection(self, selection, out=None):
+        if out is None:
+            return self.values[selection].copy()
+        out[...] = self.values[selection]
+        return out
+
+
+def read_decoded(array, path, dataset_name: str = 'bands', backend: str = 'zarr', store_cache=None):
+    """All values of a zarr array as read by the datasets, i.e. as decoded by xarray. Returns None unless the array has the dimensions DEFAULT_DIMS."""
+    if tuple(array.attrs.get('_ARRAY_DIMENSIONS', ())) != DEFAULT_DIMS:
+        return None
+    if backend == 'zarr' and is_stored_as_decoded(array):
+        return array[...]
+    import xarray as xr
+    ds = store_cache.dataset(path) if store_cache is not None else xr.open_zarr(path)
+    return ds[dataset_name].values
@@ -0,0 +1,177 @@
+import os
+import json
+import hashlib
+import warnings
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from store_cache import open_zarr_zip
+
+
+def _read_file_metadata(data_dir, modality, file_name, dataset_name):
+    """Size, shape, dtype and number of timestamps of one zarr.zip file, or None if it is missing or unreadable."""
+    path = os.path.join(data_dir, modality, file_name)
+    try:
+        size = os.path.getsize(path)
+        store, group = open_zarr_zip(path)
+        try:
+            array = group[dataset_name]
+            dims = array.attrs.get('_ARRAY_DIMENSIONS', [])
+            num_timestamps = array.shape[dims.index('time')] if 'time' in dims else 1
+            return size, array.shape, array.dtype.str, num_timestamps
+        finally:
+            store.close()
+    except Exception:
+        return None
+
+
+def build_sample_index(data_dir: str,
+                       modalities: List[str],
+                       dataset_name: str = 'bands',
+                       file_names: List[str] = None,
+                       num_threads: int = 16
+                      ):
+    """Build the index of the samples in a data directory.
+
+    Every sample must have a readable zarr.zip file for each modality. Incomplete samples are dropped with a warning.
+
+    Parameters
+    ----------
+    data_dir : str, path-like
+        Path to the data. Assumes one subfolder per modality, each containing one zarr.zip file per sample with the same file name.
+    modalities : list[str]
+        Modalities to include. Should correspond to the subfolders under data_dir.
+    dataset_name : str
+        Name of dataset in zarr archive. Defaults to 'bands'.
+    file_names : list[str]
+        Optional, file names of the samples to index. Defaults to all zarr.zip files of the first modality.
+    num_threads : int
+        Number of threads used to read the file metadata. Default is 16.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array with one record per sample, sorted by file name. The field 'file_name' holds the file name,
+        and one field per modality holds the relative 'path', the file 'size' in bytes, the 'shape' and 'dtype' of the
+        dataset and its number of timestamps 'num_timestamps'.
+    """
+    assert len(modalities) > 0, "No modalities provided."
+    if file_names is None:
+        with os.scandir(os.path.join(data_dir, modalities[0])) as entries:
+            file_names = [e.name for e in entries if e.name.endswith('.zarr.zip')]
+    file_names = sorted(file_names)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        metadata = {
+            m: list(executor.map(lambda f, m=m: _read_file_metadata(data_dir, m, f, dataset_name), file_names))
+            for m in modalities
+        }
+
+    complete = [i for i in range(len(file_names)) if all(metadata[m][i] is not None for m in modalities)]
+    if len(complete) < len(file_names):
+        warnings.warn(f"Dropped {len(file_names) - len(complete)} of {len(file_names)} samples with missing or unreadable files.")
+    assert len(complete) > 0, f"No complete samples found in {data_dir}."
+
+    ndim = max(len(metadata[m][i][1]) for m in modalities for i in complete)
+    name_len = max(len(file_names[i]) for i in complete)
+    path_len = name_len + max(len(m) for m in modalities) + 1
+    modality_dtype = np.dtype([
+        ('path', f'S{path_len}'),
+        ('size', '<i8'),
+        ('shape', '<i8', (ndim,)),
+        ('dtype', 'S8'),
+        ('num_timestamps', '<i8'),
+    ])
+    records = np.zeros(len(complete), dtype=[('file_name', f'S{name_len}')] + [(m, modality_dtype) for m in modalities])
+
+    for row, i in enumerate(complete):
+        records['file_name'][row] = file_names[i].encode()
+        for m in modalities:
+            size, shape, dtype, num_timestamps = metadata[m][i]
+            records[m][row] = (os.path.join(m, file_names[i]).encode(), size, tuple(shape) + (-1,) * (ndim - len(shape)), dtype.encode(), num_timestamps)
+
+    return records
+
+
+def _fingerprint(data_dir, modalities, dataset_name='bands', file_names=None, **kwargs):
+    """Identifies the data an index is built from: the data directory, the modification times of the modality folders,
+    which change when files are added, removed or renamed, the dataset name and the requested file names."""
+    return {
+        'data_dir': os.path.abspath(data_dir),
+        'mtimes': {m: os.stat(os.path.join(data_dir, m)).st_mtime_ns for m in modalities},
+        'dataset_name': dataset_name,
+        'file_names': hashlib.sha256('\n'.join(sorted(file_names)).encode()).hexdigest() if file_names is not None else None,
+    }
+
+
+class SampleIndex:
+
+    def __init__(self, index_file: str, repeats: int = 1):
+        """Memory-mapped index of the samples in a data directory, see build_sample_index.
+
+        The index is mapped read-only, so DataLoader workers share its pages instead of each holding a copy of the file list.
+        Pickling only transfers the file path.
+
+        Parameters
+        ----------
+        index_file : str, path-like
+            Path to the .npy index file.
+        repeats : int
+            Number of times each sample is repeated, e.g. to index every timestamp separately. Sample i is
+            record i // repeats. Default is 1.
+        """
+        self.index_file = str(index_file)
+        self.repeats = repeats
+        self.records = np.load(self.index_file, mmap_mode='r')
+        self.modalities = list(self.records.dtype.names[1:])
+
+    @classmethod
+    def load_or_build(cls, index_file: str, data_dir: str, modalities: List[str], repeats: int = 1, **kwargs):
+        """Load the index from index_file, building and saving it first if the file does not exist or is outdated.
+
+        The data the index is built from is recorded next to it in index_file + '.json'. The index is rebuilt if this
+        record is missing, or if data_dir, the modality folders (files added, removed or renamed), dataset_name or
+        file_names changed since. Files modified in place are not detected. Additional keyword arguments are passed to
+        build_sample_index.
+        """
+        fingerprint = _fingerprint(data_dir, modalities, **kwargs)
+        fingerprint_file = f'{index_file}.json'
+        try:
+            with open(fingerprint_file, 'r') as f:
+                current = json.load(f) == fingerprint and os.path.exists(index_file)
+        except (OSError, ValueError):
+            current = False
+        if not current:
+            records = build_sample_index(data_dir, modalities, **kwargs)
+            # Write to temporary files first, so that concurrent readers never see a partial index.
+            tmp_file = f'{index_file}.{os.getpid()}.tmp.npy'
+            np.save(tmp_file, records)
+            os.replace(tmp_file, index_file)
+            with open(f'{fingerprint_file}.{os.getpid()}.tmp', 'w') as f:
+                json.dump(fingerprint, f)
+            os.replace(f'{fingerprint_file}.{os.getpid()}.tmp', fingerprint_file)
+        index = cls(index_file, repeats=repeats)
+        missing = [m for m in modalities if m not in index.modalities]
+        assert len(missing) == 0, f"Index {index_file} does not include the modalities {missing}."
+        return index
+
+    def __getstate__(self):
+        return {'index_file': self.index_file, 'repeats': self.repeats}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self.records) * self.repeats
+
+    def __getitem__(self, idx):
+        return self.file_name(idx)
+
+    def file_name(self, idx):
+        """File name of sample idx."""
+        return self.records['file_name'][idx // self.repeats].decode()
+
+    def path(self, idx, modality):
+        """Path of the file of sample idx and the given modality, relative to the data directory."""
+        return self.records[modality]['path'][idx // self.repeats].decode()
@@ -0,0 +1,141 @@
+import math
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+from typing import List
+
+
+class LocalityAwareSampler(Sampler):
+
+    def __init__(self,
+                 dataset,
+                 num_replicas: int = None,
+                 rank: int = None,
+                 shuffle: bool = True,
+                 seed: int = 0,
+                 block_size: int = 64,
+                 groups: List = None,
+                 drop_last: bool = False,
+                 num_workers: int = 0,
+                 batch_size: int = 1
+                ):
+        """Distributed sampler which shuffles blocks of neighbouring files instead of single files.
+
+        The samples are grouped into blocks, by default of block_size consecutive indices, i.e. files which are next to each
+        other in the file listing, sample index or shards. Each epoch, the order of the blocks and the order within each block
+        are shuffled, and each rank takes a contiguous part of the shuffled sequence. Each rank therefore reads whole
+        blocks instead of files from the entire dataset. With num_workers, the batches of each rank are additionally
+        interleaved so that each DataLoader worker, which receives every num_workers-th batch, reads a contiguous part of them.
+
+        The order only depends on seed and the epoch set with set_epoch. set_epoch also sets the epoch of the dataset, so
+        that the randomized seasons of E2SChallengeDataset and ShardDataset and the subsampling of SSL4EOS12Dataset are
+        deterministic as well, when they are created with a seed. An interrupted epoch is resumed exactly with
+        load_state_dict(state_dict(n)), where n is the number of samples of the epoch already consumed on this rank.
+
+        Parameters
+        ----------
+        dataset : torch.utils.data.Dataset
+            Dataset to sample from.
+        num_replicas : int
+            Number of ranks. Defaults to the world size if torch.distributed is initialized, otherwise 1.
+        rank : int
+            Rank of this process. Defaults to the rank if torch.distributed is initialized, otherwise 0.
+        shuffle : bool
+            Toggle shuffling the blocks and the samples within each block. Default is True.
+        seed : int
+            Seed of the shuffling, must be the same on all ranks. Default is 0.
+        block_size : int
+            Number of consecutive indices per block, e.g. files_per_shard for ShardDataset. Ignored if groups is given. Default is 64.
+        groups : list
+            Optional, group of each sample, e.g. its shard or folder. Samples of the same group form a block.
+        drop_last : bool
+            Toggle dropping the tail of the samples to make them evenly divisible across the ranks. Otherwise the first
+            samples are repeated. Default is False.
+        num_workers : int
+            Number of DataLoader workers, for the interleaving of batches. Default is 0, where the batches are not interleaved.
+        batch_size : int
+            Batch size of the DataLoader, for the interleaving of batches. Default is 1.
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        assert 0 <= rank < num_replicas, f"Invalid rank {rank} for {num_replicas} replicas."
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.start = 0
+
+        n = len(dataset)
+        if groups is not None:
+            assert len(groups) == n, "groups must have one entry per sample."
+            _, group_ids = np.unique(np.asarray(groups), return_inverse=True)
+            order = np.argsort(group_ids, kind='stable')
+            splits = np.flatnonzero(np.diff(group_ids[order])) + 1
+            self.blocks = np.split(order, splits)
+        else:
+            self.blocks = [np.arange(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+        if drop_last:
+            self.num_samples = n // num_replicas
+        else:
+            self.num_samples = math.ceil(n / num_replicas)
+
+    def set_epoch(self, epoch: int, start: int = 0):
+        """Set the epoch, and that of the dataset if it has set_epoch. The first start samples of the epoch on this rank are skipped.
+
+        The order of the epoch is passed to the set_sample_order method of the dataset, if it has one, to read ahead the upcoming files.
+        """
+        assert 0 <= start <= self.num_samples, f"start must be between 0 and {self.num_samples}."
+        self.epoch = epoch
+        self.start = start
+        if hasattr(self.dataset, 'set_epoch'):
+            self.dataset.set_epoch(epoch)
+        if hasattr(self.dataset, 'set_sample_order'):
+            self.dataset.set_sample_order(self._epoch_indices()[self.start:], self.batch_size)
+
+    def state_dict(self, consumed: int):
+        """State to resume the current epoch after the first consumed samples of this rank."""
+        return {'epoch': self.epoch, 'start': consumed, 'seed': self.seed, 'num_replicas': self.num_replicas}
+
+    def load_state_dict(self, state: dict):
+        assert state['seed'] == self.seed and state['num_replicas'] == self.num_replicas, \
+            "The sampler can only be resumed with the same seed and number of replicas."
+        self.set_epoch(state['epoch'], start=state['start'])
+
+    def _epoch_indices(self):
+        """Indices of this rank in the current epoch, before skipping start."""
+        rng = np.random.default_rng([self.seed, self.epoch])
+        if self.shuffle:
+            blocks = [self.blocks[b] for b in rng.permutation(len(self.blocks))]
+            indices = np.concatenate([rng.permutation(block) for block in blocks])
+        else:
+            indices = np.concatenate(self.blocks)
+
+        total_size = self.num_samples * self.num_replicas
+        if total_size > len(indices):
+            indices = np.concatenate([indices, np.resize(indices, total_size - len(indices))])
+        indices = indices[self.rank * self.num_samples:(self.rank + 1) * self.num_samples]
+
+        if self.num_workers > 1:
+            # Worker w loads batches w, w + num_workers, ..., so give it a contiguous part of the batches
+            # The last, incomplete batch stays last, so that the DataLoader forms the same batches
+            n_full = len(indices) // self.batch_size
+            batches = [indices[i * self.batch_size:(i + 1) * self.batch_size] for i in range(n_full)]
+            per_worker = np.array_split(np.arange(n_full), self.num_workers)
+            interleaved = [batches[worker_batches[i]] for i in range(len(per_worker[0]))
+                           for worker_batches in per_worker if i < len(worker_batches)]
+            indices = np.concatenate(interleaved + [indices[n_full * self.batch_size:]])
+        return indices
+
+    def __iter__(self):
+        return iter(self._epoch_indices()[self.start:].tolist())
+
+    def __len__(self):
+        return self.num_samples - self.start
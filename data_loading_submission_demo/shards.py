@@ -0,0 +1,309 @@
+import os
+import json
+import torch
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import Dataset
+from typing import List
+
+from band_statistics import load_moments
+from challenge_dataset import MODALITY_MOMENTS, MODALITY_MOMENTS_SSL4EO
+from sample_index import SampleIndex, build_sample_index
+from spatial_window import SpatialWindow, window_slices
+from store_cache import is_stored_as_decoded, open_zarr_zip
+
+
+S2_MODALITIES = ['s2l1c', 's2l2a', 'S2L1C', 'S2L2A']
+
+SHARD_METADATA_FILE = 'shards.json'
+SHARD_FILE_NAMES_FILE = 'file_names.npy'
+
+
+def _shard_file(shard_dir, shard):
+    return os.path.join(shard_dir, f'shard_{shard:05d}.npy')
+
+
+def pack_shards(data_dir: str,
+                shard_dir: str,
+                modalities: List[str],
+                dataset_name: str = 'bands',
+                shift_s2_channels: bool = True,
+                files_per_shard: int = 256,
+                index_file: str = None,
+                num_threads: int = 8
+               ):
+    """Repack a directory of zarr.zip files into large shards with a fixed stride per file.
+
+    Works for both the challenge data and SSL4EO-S12 v1.1, i.e. one subfolder per modality with one zarr.zip file per
+    sample (or batch of samples) and the same file names in all subfolders. All files must have the same shape per modality.
+
+    Each shard is a .npy file holding files_per_shard files as float32, with the modalities concatenated along the
+    channel dimension in the given order, i.e. with shape [files_per_shard, *file_shape] where the file shape is
+    [n_samples, n_timestamps, n_channels, height, width] for the challenge and SSL4EO-S12 v1.1 data. The values are
+    decoded as in E2SChallengeDataset, i.e. with scale_factor, add_offset and _FillValue applied as xarray does.
+    The S2 shift is applied while packing if shift_s2_channels=True. The shard metadata and file names are written last,
+    so an interrupted conversion is not mistaken for a complete one.
+
+    Parameters
+    ----------
+    data_dir : str, path-like
+        Path to the data, with one subfolder per modality.
+    shard_dir : str, path-like
+        Output folder of the shards.
+    modalities : list[str]
+        Modalities to pack, in the order in which they are concatenated.
+    dataset_name : str
+        Name of dataset in zarr archive. Defaults to 'bands'.
+    shift_s2_channels : bool
+        Toggle shifting the S2 channels by 1000 to align to SSL4EO-S12 v1.1, see E2SChallengeDataset. Default is True.
+        Set to False for SSL4EO-S12 v1.1, which already includes the shift.
+    files_per_shard : int
+        Number of zarr.zip files per shard. Default is 256.
+    index_file : str, path-like
+        Optional, sample index to use instead of listing data_dir, see sample_index.SampleIndex.
+    num_threads : int
+        Number of threads used to read the zarr.zip files. Default is 8.
+    """
+    if index_file is not None:
+        records = SampleIndex.load_or_build(index_file, data_dir, modalities, dataset_name=dataset_name).records
+    else:
+        records = build_sample_index(data_dir, modalities, dataset_name=dataset_name)
+
+    shapes = {}
+    for m in modalities:
+        unique_shapes = np.unique(records[m]['shape'], axis=0)
+        assert len(unique_shapes) == 1, f"Files of modality {m} have different shapes: {unique_shapes.tolist()}."
+        shapes[m] = [s for s in unique_shapes[0].tolist() if s >= 0]
+    bands_per_modality = {m: shapes[m][-3] for m in modalities}
+    file_shape = list(shapes[modalities[0]])
+    file_shape[-3] = sum(bands_per_modality.values())
+
+    store, group = open_zarr_zip(os.path.join(data_dir, records[modalities[0]]['path'][0].decode()))
+    dims = group[dataset_name].attrs.get('_ARRAY_DIMENSIONS', [])
+    store.close()
+    time_axis = dims.index('time') if 'time' in dims else None
+
+    def read_file(out, row):
+        start = 0
+        for m in modalities:
+            store, group = open_zarr_zip(os.path.join(data_dir, records[m]['path'][row].decode()))
+            try:
+                # Decode as xarray does (scale_factor, add_offset, _FillValue) unless the stored values are already decoded
+                array = group[dataset_name]
+                if is_stored_as_decoded(array):
+                    values = array[...]
+                else:
+                    import xarray as xr
+                    values = xr.open_zarr(store)[dataset_name].values
+            finally:
+                store.close()
+            dest = out[..., start:start + bands_per_modality[m], :, :]
+            if shift_s2_channels and (m in S2_MODALITIES):
+                np.add(values, 1000, out=dest, casting='unsafe')
+            else:
+                np.copyto(dest, values, casting='unsafe')
+            start += bands_per_modality[m]
+
+    os.makedirs(shard_dir, exist_ok=True)
+    num_files = len(records)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for shard, first in enumerate(range(0, num_files, files_per_shard)):
+            rows = range(first, min(first + files_per_shard, num_files))
+            data = np.lib.format.open_memmap(_shard_file(shard_dir, shard), mode='w+', dtype=np.float32,
+                                             shape=(len(rows), *file_shape))
+            list(executor.map(lambda r: read_file(data[r - first], r), rows))
+            data.flush()
+            del data
+
+    np.save(os.path.join(shard_dir, SHARD_FILE_NAMES_FILE), np.asarray(records['file_name']))
+    metadata = {
+        'modalities': list(modalities),
+        'bands_per_modality': bands_per_modality,
+        'file_shape': file_shape,
+        'time_axis': time_axis,
+        'files_per_shard': files_per_shard,
+        'num_files': num_files,
+        'shift_s2_channels': shift_s2_channels,
+    }
+    with open(os.path.join(shard_dir, SHARD_METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+class ShardDataset(Dataset):
+
+    def __init__(self,
+                 shard_dir: str = None,
+                 transform = None,
+                 modalities: List[str] = None,
+                 seasons: int = 4,
+                 randomize_seasons: bool = False,
+                 concat: bool = True,
+                 output_file_name: bool = False,
+                 shift_s2_channels: bool = True,
+                 normalize: bool = False,
+                 moments = None,
+                 seed: int = None,
+                 window: SpatialWindow = None
+                ):
+        """Dataset class for data packed with pack_shards, with the same outputs as E2SChallengeDataset.
+
+        The shards are memory-mapped, so no file is opened or decompressed per sample. The output is a view of the
+        shard without any copy if the modalities are the packed modalities (or a contiguous subset of them), the seasons
+        are not randomized, shift_s2_channels matches the packed data and normalize=False. Otherwise only the selected
+        data is copied. The views are copy-on-write: in-place transforms do not modify the shard files.
+
+        Parameters
+        ----------
+        shard_dir : str, path-like
+            Path to the output folder of pack_shards.
+        transform : torch.Compose
+            Transformations to apply to the data
+        modalities : list[str]
+            List of modalities to include. Must be packed in the shards. Defaults to all packed modalities.
+        seasons : int
+            Number of seasons to load. Must be integer between 1 and the number of packed timestamps. Default is 4.
+        randomize_seasons : bool
+            Toggle randomized order of seasons. If True, the order of the seasons will be randomized. Default is False.
+        concat : bool
+            Toggle concatenating the modalities along the channel dimension. Default is True.
+        output_file_name : bool
+            Toggle output of the file name.
+        shift_s2_channels : bool
+            Toggle shifting the S2 channels by 1000 to align to SSL4EO-S12 v1.1, see E2SChallengeDataset. If the shards
+            were packed with a different setting, the shift is added or removed when loading. Default is True.
+        normalize : bool
+            Toggle per-band normalization, see E2SChallengeDataset. Default is False.
+        moments : dict or str, path-like
+            Optional, moments used with normalize=True instead of the built-in moments, see E2SChallengeDataset. Default is None.
+        seed : int
+            Optional, seed of the randomized seasons, see E2SChallengeDataset. Default is None.
+        window : spatial_window.SpatialWindow
+            Optional, spatial window of the tiles to load, see E2SChallengeDataset. Only the rows of the window are read
+            from the shards. Default is None.
+
+        Returns
+        -------
+        torch.Tensor or dict
+            See E2SChallengeDataset.
+        """
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, SHARD_METADATA_FILE), 'r') as f:
+            self.metadata = json.load(f)
+        self.file_names = np.load(os.path.join(shard_dir, SHARD_FILE_NAMES_FILE), mmap_mode='r')
+        self.transform = transform
+        self.modalities = modalities or self.metadata['modalities']
+        missing = [m for m in self.modalities if m not in self.metadata['modalities']]
+        assert len(missing) == 0, f"Modalities {missing} are not packed in {shard_dir}."
+
+        self.time_axis = self.metadata['time_axis']
+        num_timestamps = self.metadata['file_shape'][self.time_axis] if self.time_axis is not None else 1
+        assert isinstance(seasons, int) and (1 <= seasons <= num_timestamps), f"Number of seasons must be integer between 1 and {num_timestamps}."
+        self.seasons = seasons
+        self.randomize_seasons = randomize_seasons
+        if not randomize_seasons:
+            self.possible_seasons = list(range(seasons))
+        else:
+            self.possible_seasons = list(range(num_timestamps))
+        self.concat = concat
+        self.output_file_name = output_file_name
+        self.shift_s2_channels = shift_s2_channels
+        self.normalize = normalize
+        self.seed = seed
+        self.window = window
+        self.epoch = 0
+
+        # Channel indices of the selected modalities in the shards
+        packed_start = dict(zip(self.metadata['modalities'],
+                                np.cumsum([0] + list(self.metadata['bands_per_modality'].values())).tolist()))
+        self.n_bands_per_modality = {m: self.metadata['bands_per_modality'][m] for m in self.modalities}
+        self.band_index = np.concatenate([np.arange(packed_start[m], packed_start[m] + self.n_bands_per_modality[m])
+                                          for m in self.modalities])
+        if np.all(np.diff(self.band_index) == 1):
+            self.band_index = slice(int(self.band_index[0]), int(self.band_index[-1]) + 1)
+        self.start_ind_of_modality = dict(zip(self.modalities, np.cumsum([0] + list(self.n_bands_per_modality.values())).tolist()))
+
+        shift = 1000 * (int(shift_s2_channels) - int(self.metadata['shift_s2_channels']))
+        self.shift = np.concatenate([np.full(self.n_bands_per_modality[m], shift if m in S2_MODALITIES else 0, dtype=np.float32)
+                                     for m in self.modalities])[:, None, None]
+        if normalize:
+            if moments is None:
+                moments = MODALITY_MOMENTS_SSL4EO if shift_s2_channels else MODALITY_MOMENTS
+            elif not isinstance(moments, dict):
+                moments = load_moments(moments, shift_s2_channels=shift_s2_channels)
+            moments = {m.lower(): v for m, v in moments.items()}
+            assert all(m.lower() in moments for m in self.modalities), f"Normalization is only available for the modalities {list(moments)}."
+            self.mean = np.asarray(sum([moments[m.lower()][0] for m in self.modalities], []), dtype=np.float32)[:, None, None]
+            self.std = np.asarray(sum([moments[m.lower()][1] for m in self.modalities], []), dtype=np.float32)[:, None, None]
+
+        self._shards = {}
+
+    def __getstate__(self):
+        # Memory maps are reopened in each worker process
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        state['file_names'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.file_names = np.load(os.path.join(self.shard_dir, SHARD_FILE_NAMES_FILE), mmap_mode='r')
+
+    def __len__(self):
+        return self.metadata['num_files']
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch used with seed to draw different seasons in each epoch, see E2SChallengeDataset."""
+        self.epoch = epoch
+
+    def file_name(self, idx):
+        """Id of sample idx, as output with output_file_name=True."""
+        return self.file_names[idx].decode().replace('.zarr.zip', '')
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            self._shards[shard] = np.load(_shard_file(self.shard_dir, shard), mmap_mode='c')
+        return self._shards[shard]
+
+    def __getitem__(self, idx):
+
+        shard, row = divmod(idx, self.metadata['files_per_shard'])
+        file_name = self.file_name(idx)
+        data = self._shard(shard)[row]
+
+        if self.time_axis is not None:
+            if self.randomize_seasons:
+                if self.seed is None:
+                    order = torch.randperm(len(self.possible_seasons)).tolist()
+                else:
+                    order = np.random.default_rng([self.seed, self.epoch, idx]).permutation(len(self.possible_seasons)).tolist()
+                seasons = [self.possible_seasons[ind] for ind in order[:self.seasons]]
+                data = np.take(data, seasons, axis=self.time_axis)
+            elif self.seasons < data.shape[self.time_axis]:
+                data = data[(slice(None),) * self.time_axis + (slice(0, self.seasons),)]
+        data = data[..., self.band_index, :, :]
+        if self.window is not None:
+            # A different random stream than the seasons of the sample, as in E2SChallengeDataset
+            rng = np.random.default_rng([self.seed, self.epoch, idx, 1]) if self.seed is not None else None
+            window = self.window.resolve(data.shape[-2], data.shape[-1], rng)
+            data = data[(..., *window_slices(window))]
+
+        if np.any(self.shift):
+            data = data + self.shift
+        if self.normalize:
+            data = (data - self.mean) / self.std
+
+        data = torch.from_numpy(np.asarray(data))
+
+        # Transform
+        if self.transform is not None:
+            data = self.transform(data)
+
+        if not self.concat:
+            data = {m: data[..., self.start_ind_of_modality[m]: self.start_ind_of_modality[m] + self.n_bands_per_modality[m], :, :] for m in self.modalities}
+
+        if self.output_file_name:
+            if self.window is not None:
+                return {'data': data, 'file_name': file_name, 'window': window}
+            return {'data': data, 'file_name': file_name}
+        else:
+            return data
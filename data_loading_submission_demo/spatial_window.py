@@ -0,0 +1,76 @@
+import numpy as np
+import torch
+from typing import Tuple, Union
+
+
+class SpatialWindow:
+
+    def __init__(self,
+                 size: Union[int, Tuple[int, int]] = None,
+                 mode: str = 'center',
+                 origin: Tuple[int, int] = None,
+                 stride: int = 1
+                ):
+        """Spatial window of the tiles which a dataset loads, resolved per sample before reading.
+
+        Pass to E2SChallengeDataset or ShardDataset with window=. Only the window is read into the output, which is sized
+        to the window, so the S2 shift, cast, normalization, transform and the transfer from DataLoader workers only
+        process the window. zarr only reads and decodes the chunks which overlap the window, which saves decoding
+        when the tiles are chunked spatially, and memory-mapped shards only read the rows of the window.
+
+        Parameters
+        ----------
+        size : int or tuple[int, int]
+            Height and width of the window in pixels of the tile, or a single int for a square window. Default is None,
+            where the window is the whole tile, e.g. to only apply stride.
+        mode : str
+            'center' for a centered window, 'random' for a window drawn uniformly per sample, or 'fixed' for the window at
+            origin. Default is 'center'.
+        origin : tuple[int, int]
+            Row and column of the upper left pixel of the window with mode='fixed'.
+        stride : int
+            Keep every stride-th row and column of the window, e.g. 2 to halve the resolution. Default is 1.
+        """
+        assert mode in ['center', 'random', 'fixed'], "mode must be 'center', 'random' or 'fixed'."
+        assert mode != 'fixed' or origin is not None, "origin is required with mode='fixed'."
+        assert isinstance(stride, int) and stride >= 1, "stride must be a positive integer."
+        if isinstance(size, int):
+            size = (size, size)
+        assert size is None or (len(size) == 2 and all(s > 0 for s in size)), "size must be a positive int or a pair of positive ints."
+        self.size = tuple(size) if size is not None else None
+        self.mode = mode
+        self.origin = tuple(origin) if origin is not None else None
+        self.stride = stride
+
+    def resolve(self, height: int, width: int, rng: np.random.Generator = None):
+        """Window of a tile of height x width pixels.
+
+        With mode='random', the upper left pixel is drawn with rng, or with the global torch random number generator if
+        rng is None, which the DataLoader seeds per worker.
+
+        Returns
+        -------
+        dict
+            Row 'y' and column 'x' of the upper left pixel, 'height' and 'width' of the window in pixels of the tile, and 'stride'.
+        """
+        window_height, window_width = self.size if self.size is not None else (height, width)
+        if window_height > height or window_width > width:
+            raise ValueError(f"""Window of {window_height}x{window_width} pixels does not fit into a tile of {height}x{width} pixels.""")
+        if self.mode == 'center':
+            y, x = (height - window_height) // 2, (width - window_width) // 2
+        elif self.mode == 'random':
+            if rng is None:
+                y, x = [int(torch.randint(n + 1, ())) for n in [height - window_height, width - window_width]]
+            else:
+                y, x = [int(rng.integers(n + 1)) for n in [height - window_height, width - window_width]]
+        else:
+            y, x = self.origin
+            if y < 0 or x < 0 or y + window_height > height or x + window_width > width:
+                raise ValueError(f"""Window at {self.origin} of {window_height}x{window_width} pixels exceeds the tile of {height}x{width} pixels.""")
+        return {'y': y, 'x': x, 'height': window_height, 'width': window_width, 'stride': self.stride}
+
+
+def window_slices(window: dict):
+    """Row and column slices of a window returned by SpatialWindow.resolve."""
+    return (slice(window['y'], window['y'] + window['height'], window['stride']),
+            slice(window['x'], window['x'] + window['width'], window['stride']))
@@ -1,5 +1,8 @@
 # Code copied from: https://github.com/DLR-MF-DAS/SSL4EO-S12-v1.1/tree/main
-# Changes to the code: Added reference to source and license text
+# Changes to the code: Added reference to source and license text, optional caching of opened zarr.zip files,
+# optional sample index file, optional batch loading with load_batch, selection of samples and timestamps before reading,
+# reading with zarr without importing xarray, optional shared cache of decoded files, optional read-ahead of upcoming files,
+# optional per-stage timers
 # Avaliable under the Apache 2.0 license
 #                                  Apache License
 #                            Version 2.0, January 2004
@@ -202,14 +205,26 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+from __future__ import annotations
+
 import os
 import random
 import torch
-import xarray as xr
 import numpy as np
 from pathlib import Path
 from torch.utils.data import Dataset
-from torchvision import transforms
+from typing import TYPE_CHECKING
+
+from batching import empty_batch
+from loader_stats import LoaderStats, timed
+from read_ahead import ReadAhead, open_group
+from sample_cache import DecodedArray, SharedSampleCache, read_decoded
+from sample_index import SampleIndex
+from store_cache import ZarrStoreCache, dim_axis, is_stored_as_decoded, read_orthogonal_selection
+
+if TYPE_CHECKING:
+    # Only used for type hints, torchvision is not imported when loading data
+    from torchvision import transforms
 
 S2L1C_MEAN = [2607.345, 2393.068, 2320.225, 2373.963, 2562.536, 3110.071, 3392.832, 3321.154, 3583.77, 1838.712, 1021.753, 3205.112, 2545.798]
 S2L1C_STD = [786.523, 849.702, 875.318, 1143.578, 1126.248, 1161.98, 1273.505, 1246.79, 1342.755, 576.795, 45.626, 1340.347, 1145.036]
@@ -235,6 +250,15 @@ class SSL4EOS12Dataset(Dataset):
             single_timestamp: bool = False,
             num_timestamps: int = 4,
             num_batch_samples: int | None = None,
+            max_open_files: int | None = None,
+            index_file: str | Path | None = None,
+            pin_memory: bool = False,
+            seed: int | None = None,
+            backend: str = 'zarr',
+            cache: SharedSampleCache | None = None,
+            read_ahead: ReadAhead | None = None,
+            stats: LoaderStats | None = None,
+            batch_loading: bool = False,
     ):
         """
         Dataset class for the SSL4EOS12 V1.1 dataset.
@@ -245,60 +269,206 @@ class SSL4EOS12Dataset(Dataset):
         :param concat: Concatenate all modalities along the band dimension.
         :param single_timestamp: Loads a single timestamp instead of all four timestamps.
         :param num_batch_samples: Subsample samples in zarr files, e.g. if GPU memory is not sufficient.
+        :param max_open_files: optional, keep up to max_open_files zarr.zip files open per worker process for repeated access.
+            Must be at least the number of modalities. The cached files are opened from disk, so read_ahead then only warms the
+            operating system's file cache, see read_ahead.ReadAhead.
+        :param index_file: optional, sample index (.npy) which is memory-mapped instead of listing data_dir. Only samples with
+            files for all modalities are included. Built from split_file or data_dir and saved if it does not exist or is outdated.
+        :param pin_memory: Allocate batches in pinned memory when loading batches in the main process (num_workers=0).
+        :param seed: optional, seed of the subsampling with num_batch_samples. The samples drawn from a file then only depend on
+            the seed, the epoch set with set_epoch and the index, independent of the DataLoader worker which loads it.
+            Defaults to the random module, which the DataLoader seeds per worker.
+        :param backend: 'zarr' (default) reads the selected samples and timestamps with zarr directly, without building dask task
+            graphs, and only imports xarray for arrays which xarray would decode (masking or scaling). 'xarray' reads every file
+            through xr.open_zarr. Both give identical outputs.
+        :param cache: optional, sample_cache.SharedSampleCache of the decoded files, shared by all DataLoader workers and kept
+            across epochs. Whole files are decoded and cached, and the timestamp and samples are selected after the lookup.
+        :param read_ahead: optional, read_ahead.ReadAhead which reads the files of the current batch and of the next files of the
+            sampler order in background threads, for storage with a high latency. The order is set by LocalityAwareSampler.set_epoch.
+        :param stats: optional, loader_stats.LoaderStats which collects the time per loading stage and the bytes read and decoded,
+            aggregated over all DataLoader workers.
+        :param batch_loading: Load whole batches with load_batch when the DataLoader batches, instead of one file at a time.
+            The DataLoader then passes the batch to its collate_fn, so use collate_fn of this module. Defaults to False, where
+            the collate_fn of the DataLoader receives the list of files.
         """
         self.data_dir = Path(data_dir)
         self.modalities = modalities or ['S2L1C', 'S2L2A', 'S1GRD']
         self.transform = transform
         self.concat = concat
         self.num_batch_samples = num_batch_samples
+        self.pin_memory = pin_memory
+        self.seed = seed
+        assert backend in ['zarr', 'xarray'], "backend must be 'zarr' or 'xarray'."
+        self.backend = backend
+        self.cache = cache
+        self.read_ahead = read_ahead
+        self.stats = stats
+        self.batch_loading = batch_loading
+        self.epoch = 0
+        if max_open_files is not None:
+            assert max_open_files >= len(self.modalities), 'max_open_files must be at least the number of modalities.'
+            self.store_cache = ZarrStoreCache(max_open_files)
+        else:
+            self.store_cache = None
 
         if split_file is not None:
             with open(split_file, 'r') as f:
                 self.samples = f.read().splitlines()
-        else:
+        elif index_file is None:
             self.samples = os.listdir(self.data_dir / self.modalities[0])
             self.samples = [f for f in self.samples if f.endswith('.zarr.zip')]
 
         self.single_timestamp = single_timestamp
         self.num_timestamps = num_timestamps
-        if single_timestamp:
+        if index_file is not None:
+            # The index repeats samples itself to include all timestamps in the dataset
+            self.samples = SampleIndex.load_or_build(
+                index_file, self.data_dir, self.modalities, repeats=num_timestamps if single_timestamp else 1,
+                file_names=self.samples if split_file is not None else None,
+            )
+        elif single_timestamp:
             # Repeat samples to include all timestamps in the dataset
             self.samples = np.repeat(self.samples, num_timestamps)
 
     def __len__(self):
         return len(self.samples)
 
+    def set_epoch(self, epoch: int):
+        """
+        Set the epoch used with seed to draw different samples in each epoch. Call before creating the DataLoader iterator,
+        i.e. before each epoch, as persistent workers keep their copy of the dataset.
+        """
+        self.epoch = epoch
+
+    def set_sample_order(self, order: list, batch_size: int = 1):
+        """
+        Set the order in which the sampler yields the indices in the next epoch, used to read ahead the upcoming files.
+        """
+        if self.read_ahead is not None:
+            self.read_ahead.set_order(order, batch_size)
+
+    def _paths(self, idx):
+        return {m: self.data_dir / m / self.samples[idx] for m in self.modalities}
+
+    def _cache_key(self, idx):
+        return SharedSampleCache.key(str(self.data_dir), str(self.samples[idx]), self.modalities, self.backend)
+
+    def _schedule_read_ahead(self, indices):
+        """
+        Start reading the files of indices and of the next files this process loads, skipping cached files.
+        """
+        cached = (lambda idx: self._cache_key(idx) in self.cache) if self.cache is not None else None
+        self.read_ahead.schedule_samples(indices, lambda idx: self._paths(idx).values(), cached, self.store_cache)
+
+    def _select_samples(self, idx, num_samples):
+        """
+        Indices of the samples to load from the file at idx, or None to load all samples.
+        """
+        if self.num_batch_samples is None or self.num_batch_samples == num_samples:
+            return None
+        if self.seed is None:
+            return random.sample(list(range(num_samples)), k=self.num_batch_samples)
+        rng = np.random.default_rng([self.seed, self.epoch, idx])
+        return rng.choice(num_samples, size=self.num_batch_samples, replace=False).tolist()
+
+    def _open_arrays(self, idx, paths, stores):
+        """
+        Open the bands arrays of all modalities, or get their decoded values from the cache. Stores which must be closed by
+        the caller are appended to stores.
+        """
+        if self.cache is not None:
+            key = self._cache_key(idx)
+            with timed(self.stats, 'open'):
+                cached = self.cache.get(key)
+            if cached is not None:
+                return {m: DecodedArray(values) for m, values in zip(self.modalities, cached)}
+
+        arrays = {}
+        with timed(self.stats, 'open'):
+            for modality, path in paths.items():
+                arrays[modality] = open_group(path, self.read_ahead, self.store_cache, stores, self.stats)['bands']
+
+        if self.cache is not None:
+            # Decode whole files once, the timestamp and samples are selected from the cached values
+            with timed(self.stats, 'decode'):
+                decoded = [read_decoded(arrays[m], paths[m], 'bands', self.backend, self.store_cache) for m in self.modalities]
+            if all(values is not None for values in decoded):
+                self.cache.put(key, decoded)
+                return {m: DecodedArray(values) for m, values in zip(self.modalities, decoded)}
+        return arrays
+
+    def _load(self, idx):
+        """
+        Load numpy values for each modality from zarr.zip files. The timestamp (if single_timestamp=True) and the samples
+        (if num_batch_samples is set) are selected before reading, so that only their chunks are decompressed. The same
+        samples are selected in all modalities.
+        """
+        paths = self._paths(idx)
+        stores = []
+        try:
+            arrays = self._open_arrays(idx, paths, stores)
+            time_idx = idx % self.num_timestamps if self.single_timestamp else None
+            first = arrays[self.modalities[0]]
+            selected = self._select_samples(idx, first.shape[dim_axis(first, 'sample')])
+
+            data = {}
+            for modality, array in arrays.items():
+                with timed(self.stats, 'decode'):
+                    if isinstance(array, DecodedArray) or (self.backend == 'zarr' and is_stored_as_decoded(array)):
+                        selection = [slice(None)] * array.ndim
+                        if selected is not None:
+                            # Subsample samples
+                            selection[dim_axis(array, 'sample')] = selected
+                        if time_idx is not None:
+                            # Select a single timestamp
+                            selection[dim_axis(array, 'time')] = time_idx
+                        data[modality] = read_orthogonal_selection(array, selection)
+                    else:
+                        data[modality] = self._load_xarray(paths[modality], time_idx, selected)
+                if self.stats is not None:
+                    self.stats.add('bytes_decoded', data[modality].nbytes)
+        finally:
+            for store in stores:
+                store.close()
+        return data
+
+    def _load_xarray(self, path, time_idx, selected):
+        """
+        Load the selected timestamp and samples of the bands in the zarr.zip file at path through xarray.
+        """
+        import xarray as xr
+        ds = self.store_cache.dataset(path) if self.store_cache is not None else xr.open_zarr(path)
+        selection = {}
+        if time_idx is not None:
+            selection['time'] = time_idx
+        if selected is not None:
+            selection['sample'] = selected
+        bands = ds.bands.isel(selection) if selection else ds.bands
+        return bands.values
+
     def __getitem__(self, idx):
         """
         :param idx: Index of zarr.zip file.
         :return: dict of modalities or tensor (if concat=True) with dims [B, T, C, H, W] or [B, C, H, W]
             (if single_timestamp=True).
         """
-        data = {}
-        # Load numpy values for each modality from zarr.zip files
-        for modality in self.modalities:
-            ds = xr.open_zarr(self.data_dir / modality / self.samples[idx])
-            if self.single_timestamp:
-                # Select a single timestamp
-                ds = ds.isel(time=idx % self.num_timestamps)
-            data[modality] = ds.bands.values
-
-        num_samples = data[self.modalities[0]].shape[0]
-        if self.num_batch_samples is not None and self.num_batch_samples != num_samples:
-            # Subsample samples
-            selected = random.sample(list(range(num_samples)), k=self.num_batch_samples)
-            for modality in self.modalities:
-                data[modality] = data[modality][selected]
+        if self.read_ahead is not None:
+            self._schedule_read_ahead([idx])
+        data = self._load(idx)
 
         # Save band dims in case of dict outputs
         num_band_dims = {m: data[m].shape[-3] for m in self.modalities}
         band_dims_idx = {m: n for m, n in zip(self.modalities, [0] + np.cumsum(list(num_band_dims.values())).tolist())}
 
         # Concatenate along band dim for transform and convert to Tensor
-        data = torch.Tensor(np.concatenate(list(data.values()), axis=-3))
+        with timed(self.stats, 'cast'):
+            data = torch.Tensor(np.concatenate(list(data.values()), axis=-3))
 
         if self.transform is not None:
-            data = self.transform(data)
+            with timed(self.stats, 'transform'):
+                data = self.transform(data)
+        if self.stats is not None:
+            self.stats.add('items')
 
         if not self.concat:
             # Split up modality data and return as dict
@@ -307,6 +477,64 @@ class SSL4EOS12Dataset(Dataset):
 
         return data
 
+    def __getitems__(self, indices):
+        """
+        Files at indices, called by the DataLoader when batching.
+        :param indices: Indices of zarr.zip files.
+        :return: The batch loaded with load_batch if batch_loading=True, otherwise the list of files as returned by __getitem__.
+        """
+        if self.batch_loading:
+            return self.load_batch(indices)
+        if self.read_ahead is not None:
+            self._schedule_read_ahead(indices)
+        return [self[idx] for idx in indices]
+
+    def load_batch(self, indices):
+        """
+        Load a batch of zarr.zip files directly into preallocated batch tensors.
+        Returns the same output as collate_fn applied to the individual files. Each file is copied once into the batch,
+        allocated in shared memory in DataLoader workers. The transform is applied per file, as in __getitem__.
+        :param indices: Indices of zarr.zip files.
+        :return: dict of modalities or tensor (if concat=True) with dims [B, T, C, H, W] or [B, C, H, W]
+            (if single_timestamp=True).
+        """
+        if self.read_ahead is not None:
+            self._schedule_read_ahead(indices)
+        # Files can hold different numbers of samples, which are concatenated as by collate_fn
+        files = [self._load(idx) for idx in indices]
+        offsets = np.cumsum([0] + [data[self.modalities[0]].shape[0] for data in files]).tolist()
+
+        num_band_dims = {m: files[0][m].shape[-3] for m in self.modalities}
+        band_dims_idx = {m: n for m, n in zip(self.modalities, [0] + np.cumsum(list(num_band_dims.values())).tolist())}
+        shape = list(files[0][self.modalities[0]].shape)
+        shape[0] = offsets[-1]
+        if self.concat or self.transform is not None:
+            shape[-3] = sum(num_band_dims.values())
+            batch = empty_batch(shape, self.pin_memory)
+            outs = {m: batch.numpy()[..., band_dims_idx[m]:band_dims_idx[m]+num_band_dims[m], :, :]
+                    for m in self.modalities}
+        else:
+            batch = {m: empty_batch(shape[:-3] + [num_band_dims[m]] + shape[-2:], self.pin_memory)
+                     for m in self.modalities}
+            outs = {m: b.numpy() for m, b in batch.items()}
+
+        for i, data in enumerate(files):
+            for m in self.modalities:
+                with timed(self.stats, 'cast'):
+                    np.copyto(outs[m][offsets[i]:offsets[i + 1]], data[m], casting='unsafe')
+        if self.stats is not None:
+            self.stats.add('items', len(indices))
+
+        if self.transform is not None:
+            with timed(self.stats, 'transform'):
+                batch = torch.concat([self.transform(batch[offsets[i]:offsets[i + 1]]) for i in range(len(indices))], dim=0)
+            if not self.concat:
+                # Split up modality data and return as dict
+                batch = {m: batch[..., band_dims_idx[m]:band_dims_idx[m]+num_band_dims[m], :, :]
+                         for m in self.modalities}
+
+        return batch
+
 
 def collate_fn(batch):
     if isinstance(batch, dict) or isinstance(batch, torch.Tensor):
@@ -0,0 +1,202 @@
+import io
+import os
+import itertools
+import zipfile
+import numpy as np
+import zarr
+from collections import OrderedDict
+from threading import RLock
+
+
+# Array attributes which make xarray decode (mask or scale) the stored values.
+_CF_DECODING_ATTRS = ('_FillValue', 'missing_value', 'scale_factor', 'add_offset', '_Unsigned')
+
+# Dimensions of the bands arrays of the challenge and SSL4EO-S12 v1.1 data
+DEFAULT_DIMS = ('sample', 'time', 'band', 'y', 'x')
+
+
+class _BytesZipStore(zarr.storage.ZipStore):
+    """Read-only ZipStore of a .zarr.zip archive which was read into memory."""
+
+    def __init__(self, path, data):
+        # Same attributes as ZipStore(path, mode='r'), but the zip file is opened on the bytes instead of the path
+        self.path = os.path.abspath(path)
+        self.compression = zipfile.ZIP_STORED
+        self.allowZip64 = True
+        self.mode = 'r'
+        self._dimension_separator = None
+        self.mutex = RLock()
+        self.zf = zipfile.ZipFile(io.BytesIO(data), mode='r')
+
+
+def open_zarr_zip(path, data: bytes = None):
+    """Open a .zarr.zip archive read-only.
+
+    Parameters
+    ----------
+    path : str, path-like
+        Path to the .zarr.zip archive.
+    data : bytes
+        Optional, content of the archive already read into memory, e.g. by read_ahead.ReadAhead. The archive is then
+        read from memory instead of from path.
+
+    Returns
+    -------
+    tuple[zarr.storage.ZipStore, zarr.Group]
+        The opened store, which should be closed by the caller, and the root group. Consolidated metadata is used if present.
+    """
+    if data is not None:
+        store = _BytesZipStore(str(path), data)
+    else:
+        store = zarr.storage.ZipStore(str(path), mode='r')
+    if '.zmetadata' in store:
+        group = zarr.open_consolidated(store, mode='r')
+    else:
+        group = zarr.open_group(store, mode='r')
+    return store, group
+
+
+def is_stored_as_decoded(array):
+    """Check whether xarray would return the stored values of a zarr array unchanged, i.e. the array can be read with zarr directly."""
+    if '_ARRAY_DIMENSIONS' not in array.attrs or any(a in array.attrs for a in _CF_DECODING_ATTRS):
+        return False
+    fill_value = array.fill_value
+    return fill_value is None or (np.issubdtype(array.dtype, np.floating) and np.isnan(fill_value))
+
+
+def dim_axis(array, dim, default_dims=DEFAULT_DIMS):
+    """Position of the dimension dim of a zarr array written by xarray."""
+    return list(array.attrs.get('_ARRAY_DIMENSIONS', default_dims)).index(dim)
+
+
+def read_orthogonal_selection(array, selection):
+    """Read an orthogonal selection of a zarr array, with the same result as array.get_orthogonal_selection(selection).
+
+    Lists of indices are split into runs of consecutive indices, which are read with basic selections into a
+    preallocated output. zarr decodes these much faster than its integer array indexing, which is slow for large chunks.
+
+    Parameters
+    ----------
+    array : zarr.Array
+        Array to read.
+    selection : tuple
+        One int, slice or list of int per leading dimension of the array. Missing dimensions are read fully.
+
+    Returns
+    -------
+    np.ndarray
+        Selected values in the dtype of the array.
+    """
+    selection = list(selection) + [slice(None)] * (array.ndim - len(selection))
+    # Per dimension, the (array selection, output selection) of each run. Integer selections drop the dimension.
+    runs, shape = [], []
+    for sel, size in zip(selection, array.shape):
+        if isinstance(sel, (int, np.integer)):
+            runs.append([(int(sel), None)])
+        elif isinstance(sel, slice):
+            runs.append([(sel, slice(None))])
+            shape.append(len(range(*sel.indices(size))))
+        else:
+            sel = [int(i) for i in sel]
+            dim_runs, start = [], 0
+            for end in range(1, len(sel) + 1):
+                if end == len(sel) or sel[end] != sel[end - 1] + 1:
+                    dim_runs.append((slice(sel[start], sel[end - 1] + 1), slice(start, end)))
+                    start = end
+            runs.append(dim_runs)
+            shape.append(len(sel))
+
+    out = np.empty(shape, dtype=array.dtype)
+    for combination in itertools.product(*runs):
+        out_selection = tuple(o for _, o in combination if o is not None)
+        array.get_basic_selection(tuple(s for s, _ in combination), out=out[out_selection])
+    return out
+
+
+class _CachedZarrZip:
+    """Opened .zarr.zip archive with the views derived from it, created on first use."""
+
+    def __init__(self, path):
+        self.store, self.group = open_zarr_zip(path)
+        self._dataset = None
+
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            # Imported on first use, so that processes which only read through zarr do not import xarray and dask
+            import xarray as xr
+            self._dataset = xr.open_zarr(self.store)
+        return self._dataset
+
+    def close(self):
+        if self._dataset is not None:
+            self._dataset.close()
+        self.store.close()
+
+
+class ZarrStoreCache:
+
+    def __init__(self, max_open_files: int = 64):
+        """Least recently used cache of opened .zarr.zip archives.
+
+        Keeping the archives open avoids re-reading the zip central directory, the zarr metadata and the coordinates
+        every time a sample is accessed. Each process keeps its own open files: the cache is emptied when it is used
+        from a new process, e.g. in a DataLoader worker, and it is pickled without any open files.
+
+        Parameters
+        ----------
+        max_open_files : int
+            Maximum number of archives kept open. When exceeded, the least recently used archive is closed. Default is 64.
+        """
+        assert isinstance(max_open_files, int) and max_open_files > 0, "max_open_files must be a positive integer."
+        self.max_open_files = max_open_files
+        self._entries = OrderedDict()
+        self._pid = os.getpid()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        return {'max_open_files': self.max_open_files}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            # File handles inherited from the parent process share their offset with it and must not be used.
+            self._entries = OrderedDict()
+            self._pid = os.getpid()
+
+    def __contains__(self, path):
+        self._check_process()
+        return str(path) in self._entries
+
+    def _get(self, path):
+        self._check_process()
+        path = str(path)
+        entry = self._entries.get(path)
+        if entry is not None:
+            self._entries.move_to_end(path)
+            return entry
+
+        entry = _CachedZarrZip(path)
+        self._entries[path] = entry
+        while len(self._entries) > self.max_open_files:
+            _, evicted = self._entries.popitem(last=False)
+            evicted.close()
+        return entry
+
+    def group(self, path):
+        """Root zarr group of the archive at path."""
+        return self._get(path).group
+
+    def dataset(self, path):
+        """Lazily loaded xarray dataset of the archive at path, equivalent to xr.open_zarr(path)."""
+        return self._get(path).dataset
+
+    def close(self):
+        """Close all open archives."""
+        while self._entries:
+            _, entry = self._entries.popitem()
+            entry.close()
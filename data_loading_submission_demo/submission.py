@@ -0,0 +1,180 @@
+import os
+import numpy as np
+import pandas as pd
+from typing import Iterable
+
+
+class SubmissionWriter:
+
+    def __init__(self,
+                 path: str,
+                 embedding_dim: int = 1024,
+                 float_format: str = '%+.8e',
+                 append: bool = False
+                ):
+        """Incremental writer of submission files.
+
+        Writes the same csv layout as the notebooks, i.e. a header 'id,0,1,...' followed by one row per sample, but
+        formats each batch of embeddings as it is produced instead of collecting all embeddings in memory first.
+        Each batch is written with a single np.savetxt call.
+
+        Parameters
+        ----------
+        path : str, path-like
+            Path of the submission file.
+        embedding_dim : int
+            Number of embedding dimensions. Default is 1024.
+        float_format : str
+            printf-style format of the embedding values. The default '%+.8e' keeps 9 significant digits, which is exact for float32 embeddings,
+            and writes an explicit sign, so that every value has the same width (for exponents below 100, i.e. all float32 values) and rows
+            with ids of equal length have the same width. Use e.g. '%+.16e' to keep float64 embeddings exact.
+        append : bool
+            Toggle appending to an existing submission file instead of overwriting it. The header is only written to a new or empty file. Default is False.
+
+        Examples
+        --------
+        >>> with SubmissionWriter('submission.csv') as writer:
+        ...     for batch in dataloader:
+        ...         writer.write(batch['file_name'], model(batch['data']))
+        """
+        self.path = path
+        self.embedding_dim = embedding_dim
+        self.float_format = float_format
+        self._fmt = ['%s'] + [float_format] * embedding_dim
+        write_header = not append or not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a' if append else 'w', buffering=1 << 20)
+        if write_header:
+            self._file.write(','.join(['id'] + [str(i) for i in range(embedding_dim)]) + '\n')
+        self.n_written = 0
+
+    def write(self, ids: Iterable[str], embeddings):
+        """Append a batch of embeddings.
+
+        Parameters
+        ----------
+        ids : list[str]
+            Sample ids (file names) of the batch.
+        embeddings : np.ndarray or torch.Tensor
+            Embeddings of shape [batch_size, embedding_dim], or [embedding_dim] for a single id.
+        """
+        if isinstance(ids, str):
+            ids = [ids]
+        if hasattr(embeddings, 'detach'):
+            embeddings = embeddings.detach().cpu().numpy()
+        embeddings = np.asarray(embeddings).reshape(len(ids), -1)
+        if embeddings.shape[1] != self.embedding_dim:
+            raise ValueError(f"""{self.embedding_dim} embedding dimensions expected, but provided embeddings have {embeddings.shape[1]} dimensions.""")
+        if not np.all(np.isfinite(embeddings)):
+            raise ValueError(f"""Embeddings contain NaN or infinite values.""")
+
+        rows = np.empty((len(ids), self.embedding_dim + 1), dtype=object)
+        rows[:, 0] = ids
+        rows[:, 1:] = embeddings
+        np.savetxt(self._file, rows, fmt=self._fmt, delimiter=',')
+        self.n_written += len(rows)
+
+    def flush(self):
+        """Flush written rows to disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_submission_from_dict(emb_dict: dict, path: str, embedding_dim: int = 1024, batch_size: int = 1024, **kwargs):
+    """Write a dictionary of the format {hash-id0: embedding0, hash-id1: embedding1, ...} to a submission file.
+
+    Writes the same ids and columns as create_submission_from_dict(emb_dict).to_csv(path, index=False) in the notebooks, without
+    creating a DataFrame. The values are written with the float_format of SubmissionWriter instead of the shortest representation
+    which pandas writes. The default keeps float32 embeddings exact, but rounds float64 embeddings to 9 significant digits.
+    Additional keyword arguments are passed to SubmissionWriter.
+    """
+    ids = list(emb_dict.keys())
+    with SubmissionWriter(path, embedding_dim=embedding_dim, **kwargs) as writer:
+        for start in range(0, len(ids), batch_size):
+            batch_ids = ids[start:start + batch_size]
+            writer.write(batch_ids, np.stack([np.asarray(emb_dict[i]).reshape(-1) for i in batch_ids]))
+
+
+def _read_submission_chunks(path_to_submission, columns, chunk_size):
+    """Parse the submission file in chunks, with the embedding values as float64 and the ids as strings."""
+    dtypes = {c: np.float64 for c in columns if c != 'id'}
+    dtypes['id'] = str
+    try:
+        yield from pd.read_csv(path_to_submission, header=0, dtype=dtypes, chunksize=chunk_size)
+    except (ValueError, TypeError, pd.errors.ParserError) as e:
+        raise ValueError(f"""Failed to convert embedding values to float.
+    Check embeddings for any not-allowed character, for example empty strings, letters, etc.
+    Original error message: {e}""")
+
+
+def validate_submission(path_to_submission: str,
+                        expected_embedding_ids: set = None,
+                        embedding_dim: int = 1024,
+                        chunk_size: int = 10000
+                       ):
+    """Check a submission file for the errors which the evaluation checks for.
+
+    Performs the same checks as test_submission in the notebooks, but streams over the file in chunks of rows, so
+    the memory use does not grow with the size of the file. Additionally checks for infinite
+    values and duplicate ids.
+
+    Parameters
+    ----------
+    path_to_submission : str, path-like
+        Path to the submission file.
+    expected_embedding_ids : set
+        Optional, ids which must be included in the submission.
+    embedding_dim : int
+        Number of embedding dimensions. Default is 1024.
+    chunk_size : int
+        Number of rows parsed at a time. Default is 10000.
+
+    Returns
+    -------
+    bool
+        True if no errors were found, otherwise a ValueError is raised.
+    """
+    columns = pd.read_csv(path_to_submission, header=0, nrows=0).columns
+
+    # Verify that id is in columns
+    if 'id' not in columns:
+        raise ValueError(f"""Submission file must contain column 'id'.""")
+
+    # Check that embeddings have the correct length
+    if len(columns) - 1 != embedding_dim:
+        raise ValueError(f"""{embedding_dim} embedding dimensions, but provided embeddings have {len(columns) - 1} dimensions.""")
+
+    submitted_embeddings = set()
+    n_rows = 0
+    for chunk in _read_submission_chunks(path_to_submission, columns, chunk_size):
+        values = chunk.drop(columns='id').to_numpy()
+
+        # Check if any NaNs or infinite values
+        if np.isnan(values).any():
+            raise ValueError(f"""Embeddings contain NaN values.""")
+        if np.isinf(values).any():
+            raise ValueError(f"""Embeddings contain infinite values.""")
+
+        submitted_embeddings.update(chunk['id'])
+        n_rows += len(chunk)
+
+    if len(submitted_embeddings) != n_rows:
+        raise ValueError(f"""Submission contains {n_rows - len(submitted_embeddings)} duplicate ids.""")
+
+    # Check that all samples are included
+    if expected_embedding_ids is not None:
+        n_missing_embeddings = len(set(expected_embedding_ids).difference(submitted_embeddings))
+        if n_missing_embeddings > 0:
+            raise ValueError(f"""Submission is missing {n_missing_embeddings} embeddings.""")
+
+    # Successful completion of the function
+    return True